@@ -0,0 +1,42 @@
+# Description: Process-wide event loop and pooled HTTP session for asynchronous API calls
+import asyncio
+import threading
+import aiohttp
+import openai
+
+#Connections are kept alive and reused across turns and sessions
+CONNECTION_LIMIT = 32
+KEEPALIVE_TIMEOUT = 60
+
+_loop = None
+_session = None
+_lock = threading.Lock()
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """returns the event loop shared by every script thread, starting it on first use"""
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name='aio-loop', daemon=True)
+            thread.start()
+        return _loop
+
+def get_session() -> aiohttp.ClientSession:
+    """returns the pooled HTTP session and makes openai use it in the current task.
+    Must be called from the shared loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT, keepalive_timeout=KEEPALIVE_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector)
+    openai.aiosession.set(_session)
+    return _session
+
+def submit(coro):
+    """schedules coro on the shared loop from any thread. returns a concurrent.futures.Future"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+def run(coro):
+    """runs coro on the shared loop and waits for its result. Must not be called from the loop itself."""
+    return submit(coro).result()
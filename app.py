@@ -1,146 +1,231 @@
 # import asyncio
-import pinecone
 import os
 import streamlit as st
 import re
 import base64
+import functools
 import time
-import elevenlabs as el
+import uuid
+from types import MappingProxyType
 from utils import extract_video_link_and_start_time
 from politicians import POLITICIANS
-from chain import Chain, Profile
+from chain import Chain, Profile, Turn, API_ERRORS, SpeechError
+from pool import OverloadedError
+from context import ConversationContext
+from audio import Timeline, get_mp3_duration
+from tracing import span, get_stats
 
-def display_message(response: dict, stream_response: bool = False) -> int:
-    "returns elapsed time to display message"
-    #autoplay audio and stream reponse in approx same time.
-    def display_transcription(output_text: str, elapsed_time: int=30, placeholder=None) -> str:
-        if placeholder is None:
-            placeholder = st.empty()
-        full_response = ''
-        placeholder.markdown(full_response)
-        # Simulate stream of response with milliseconds delay
-        split = output_text.split()
-        nchunks = len(split)
-        interval = elapsed_time / nchunks
-        for chunk in split:
-            full_response += chunk + " "
-            time.sleep(interval)
-            # Add a blinking cursor to simulate typding
-            placeholder.markdown(full_response + "▌")
-        placeholder.markdown(full_response)
-        return full_response
-
-    def display_audio(audio: bytes, placeholder=None):
-        if placeholder is None:
-            placeholder = st.empty()
-        audio_base64 = base64.b64encode(audio).decode('utf-8')
-        audio_tag = f'<audio controls src="data:audio/wav;base64,{audio_base64}">'
-        placeholder.markdown(audio_tag, unsafe_allow_html=True)
-    
-    def autoplay_audio(file_path: str = None, data: bytes = None, display_player: bool = True):
-        if data is not None:
-            audio_base64 = base64.b64encode(data).decode('utf-8')
-            audio_tag = f'<audio {"controls " if display_player else "" }autoplay="true" src="data:audio/wav;base64,{audio_base64}">'
-
-        elif file_path is not None:
-            with open(file_path, "rb") as f:
-                data = f.read()
-                b64 = base64.b64encode(data).decode()
-                audio_tag = f"""
-                    <audio {"controls " if display_player else "" }autoplay="true">
-                    <source src="data:audio/mp3;base64,{b64}" type="audio/mp3">
-                    </audio>
-                    """
-    
-        st.markdown(audio_tag, unsafe_allow_html=True)
+def display_audio(audio: bytes, placeholder=None):
+    if placeholder is None:
+        placeholder = st.empty()
+    # registered once with streamlit's media file manager and served by a stable url,
+    # so reruns don't resend the bytes
+    placeholder.audio(audio, format=AUDIO_FORMAT)
 
-    def get_audio_length(audio: bytes) -> int:
-        bit_rate = 128000
-        length = len(audio) / bit_rate * 8
-        return int(length)
+def get_autoplay_tag(data: bytes, display_player: bool) -> str:
+    audio_base64 = base64.b64encode(data).decode('utf-8')
+    return f'<audio {"controls " if display_player else "" }autoplay="true" src="data:{AUDIO_FORMAT};base64,{audio_base64}">'
 
-    def display_citations(citations, placeholder=None):
-        if len(citations) == 0:
-            return
-        if placeholder is None:
-            placeholder = st.empty()
-        references, links = citations
-        # convert references to references in string format
-        references = [str(reference) for reference in references]
-        tabs = placeholder.tabs(references)
-        for tab, reference, link in zip(tabs, references, links):
-            video_link, start_time = extract_video_link_and_start_time(link)
-            with tab:
-                st.video(video_link, start_time=start_time)
+def autoplay_audio(file_path: str = None, data: bytes = None, display_player: bool = True, placeholder=None):
+    if placeholder is None:
+        placeholder = st
+    if file_path is not None:
+        with open(file_path, "rb") as f:
+            data = f.read()
+    audio_tag = get_autoplay_tag(data, display_player)
+    placeholder.markdown(audio_tag, unsafe_allow_html=True)
 
+def display_citations(citations, placeholder=None):
+    if len(citations) == 0:
+        return
+    if placeholder is None:
+        placeholder = st.empty()
+    references, links = citations
+    # convert references to references in string format
+    references = [str(reference) for reference in references]
+    tabs = placeholder.tabs(references)
+    for tab, reference, link in zip(tabs, references, links):
+        video_link, start_time = extract_video_link_and_start_time(link)
+        with tab:
+            st.video(video_link, start_time=start_time)
+
+def display_header(name: str, shortcode: str):
+    header = f"**{name}** @{shortcode}"
+    st.markdown(header)
+
+def display_message(response: dict):
     # Extract audio response from response dict
     audio_response = response.get('audio', None)
     name = response.get('role', None)
     avatar = response.get('avatar', None)
     
-    with st.chat_message(name=name, avatar=avatar):
-
-        if name == "user" or name == "Molus":
-            st.markdown(response["content"])
-            return
-
-        shortcode = response.get('shortcode', None)
-        header = f"**{name}** @{shortcode}"
-        st.markdown(header)
-
-        # Extract transcribed response from response dict
-        assistant_response = response.get('content', None)
-        elapsed_time = 0
-
-        if stream_response:
-            stream_time = get_audio_length(audio_response)
-            transcribe_time = 3
-            # autoplay audio response
-            autoplay_audio(data=audio_response, display_player=True)
-            # Stream transcribed response at same time as audio
-            display_transcription(assistant_response, elapsed_time=transcribe_time)
-            elapsed_time = stream_time - transcribe_time
-        else:
+    with span('display_message', role=name, audio_bytes=len(audio_response or b'')):
+        with st.chat_message(name=name, avatar=avatar):
+
+            if name == "user" or name == "Molus":
+                st.markdown(response["content"])
+                return
+
+            display_header(name, response.get('shortcode', None))
             display_audio(audio_response)
-            st.markdown(assistant_response)
+            st.markdown(response.get('content', None))
+            display_citations(response.get('citations', None))
+
+def display_turn(turn: Turn, timeline: Timeline) -> dict:
+    """streams the turn's response as tokens arrive and schedules each sentence's audio on the timeline
+    as soon as it is synthesized and the previous clip has finished, then shows citations.
+    returns the full response once its last sentence has started playing
+    """
+    profile = turn.profile
+    with span('display_turn', politician=profile.name) as display_span:
+        with st.chat_message(name=profile.name, avatar=profile.avatar):
+            display_header(profile.name, profile.shortcode)
+            placeholder = st.empty()
+            audio_placeholder = st.empty()
+            streamed = ''
+            segment = 0
+            while turn.streaming or not turn.is_spoken(segment):
+                tokens = turn.poll()
+                if len(tokens) > 0:
+                    streamed += ''.join(tokens)
+                    # Add a blinking cursor while the response is generated
+                    placeholder.markdown(streamed + "▌")
+
+                if timeline.is_free() and (audio := turn.get_segment(segment)) is not None:
+                    autoplay_audio(data=audio, display_player=False, placeholder=audio_placeholder)
+                    timeline.play(get_mp3_duration(audio))
+                    display_span.add('audio_bytes', len(audio))
+                    segment += 1
 
-        citations = response.get('citations', None)
-        display_citations(citations)
+                # wake up exactly when the current clip ends, or on the next poll
+                time.sleep(min(POLL_INTERVAL, timeline.remaining()) or POLL_INTERVAL)
 
-        return elapsed_time
+            response = turn.result()
+            placeholder.markdown(response['content'])
+            display_citations(response['citations'])
+
+    return response
+
+def display_trace_panel(placeholder):
+    """shows rolling p50/p95 latency per stage in a sidebar placeholder, replacing what it showed before"""
+    stats = get_stats()
+    if len(stats) == 0:
+        return
+    with placeholder.container():
+        st.markdown("**Latency per stage**")
+        st.table({
+            "stage": list(stats.keys()),
+            "count": [ s['count'] for s in stats.values() ],
+            "p50 (ms)": [ s['p50_ms'] for s in stats.values() ],
+            "p95 (ms)": [ s['p95_ms'] for s in stats.values() ],
+        })
 
 def run_and_display_chain(chain: Chain):
     """
-    call to debate.next_message()
-    streamout the next available message
-    append the next message to debate manager
-    repeat until debate is over
+    stream each turn of the chain as it is generated
+    show the next speaker exactly when the previous speaker's audio ends,
+    while later turns keep generating in the background
+    append each response to the chat history once it is shown; the chain moves it into the context
     """
-    #TODO: implement timeout we don't display two messages at once
-    responses = []
-    profile = chain.get_start()
-    time_to_display = 0
-    prev_display_time = 0
-    while profile:
-        response = profile.get_response()
-        curr_time = time.time()
-        if curr_time - prev_display_time < time_to_display:
-            time.sleep(time_to_display - (curr_time - prev_display_time) + 1)
-        time_to_display = display_message(response, stream_response=True)
-        prev_display_time = time.time()
-        st.session_state.messages.append(response)
-        profile = chain.next_profile()
+    timeline = Timeline()
+    try:
+        for turn in chain.run(st.session_state.context):
+            timeline.wait()
+            response = display_turn(turn, timeline)
+            st.session_state.messages.append(response)
+
+    except API_ERRORS:
+        st.error("OpenAI API is currently unavailable. Please try again later.")
+        st.stop()
+
+    except SpeechError:
+        st.error("ElevenLabs text to speech is currently unavailable. Please try again later.")
+        st.stop()
+
+    except OverloadedError:
+        st.warning("Too many conversations are running right now. Please try again in a minute.")
+        st.stop()
 
 USER_PROFILE_PIC = '🫨'
-pinecone.init(
-    api_key=os.environ.get('PINECONE_API_KEY'),
-    environment=os.environ.get('PINECONE_ENV')
-)
-INDEX = pinecone.Index('v1')
-el.set_api_key(os.environ.get('ELEVENLABS_API_KEY'))
+#ElevenLabs returns mp3
+AUDIO_FORMAT = 'audio/mpeg'
+#how each turn's knowledge base query is built, see chain.RETRIEVAL_MODES
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'llm')
+#seconds between checks for new tokens and audio while a turn is displayed
+POLL_INTERVAL = 0.05
+#with TRACE_PANEL=1 the sidebar shows rolling latency percentiles per stage, see tracing.py
+TRACE_PANEL = os.environ.get('TRACE_PANEL', '0') == '1'
 
-#session state initialization
-if "messages" not in st.session_state:
+def timed(name: str):
+    """reports how long the decorated startup step takes. Combined with st.cache_resource,
+    this prints once per process, when the resource is first built.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            print(f'Startup: {name} took {time.perf_counter() - start:.3f}s')
+            return result
+        return wrapper
+    return decorator
+
+@st.cache_resource
+@timed('knowledge base index')
+def get_index():
+    #knowledge base backend: 'pinecone' (default), 'local' memory-mapped index built by setup/index.py,
+    #or 'ivfpq' compressed index trained over it by setup/train_ivfpq.py
+    backend = os.environ.get('KB_BACKEND', 'pinecone')
+    if backend == 'local':
+        from vectorstore import LocalIndex
+        return LocalIndex(os.environ.get('LOCAL_INDEX_PATH', 'setup/local_index'))
+    if backend == 'ivfpq':
+        from vectorstore import IVFPQIndex
+        #with a chunk store serving the text, workers only load the chunk ids
+        return IVFPQIndex(os.environ.get('LOCAL_INDEX_PATH', 'setup/local_index'), metadata=os.environ.get('CHUNK_STORE', '0') != '1')
+
+    import pinecone
+    pinecone.init(
+        api_key=os.environ.get('PINECONE_API_KEY'),
+        environment=os.environ.get('PINECONE_ENV')
+    )
+    return pinecone.Index('v1')
+
+@st.cache_resource
+@timed('lexical index')
+def get_lexical_index():
+    #'hybrid' fuses BM25 search over the transcripts with vector search, 'vector' uses vector search only
+    if os.environ.get('KB_SEARCH', 'vector') != 'hybrid':
+        return None
+    from lexical import LexicalIndex
+    return LexicalIndex(os.environ.get('LEXICAL_INDEX_PATH', 'setup/lexical_index'))
+
+@st.cache_resource
+@timed('chunk store')
+def get_chunk_store():
+    #with CHUNK_STORE=1, chunk text is read from the local store written by setup/index.py instead of index metadata
+    if os.environ.get('CHUNK_STORE', '0') != '1':
+        return None
+    from chunkstore import ChunkStore
+    return ChunkStore(os.environ.get('CHUNK_STORE_PATH', 'setup/chunk_store'))
+
+@st.cache_resource
+@timed('profiles')
+def get_profiles() -> MappingProxyType:
+    """returns the process-wide registry of profiles keyed by shortcode.
+    Profiles hold no per-session state, so every session and chain shares them.
+    """
+    index = get_index()
+    lexical = get_lexical_index()
+    chunks = get_chunk_store()
+    profiles = {
+        info['shortcode']: Profile(index=index, shortcode=info['shortcode'], lexical=lexical, chunks=chunks)
+        for info in POLITICIANS.values()
+    }
+    return MappingProxyType(profiles)
+
+@st.cache_resource
+def get_intro() -> str:
     politician_names = list(POLITICIANS.keys())
     politician_names.sort()
     #display message with politician names, images, and shortcodes
@@ -149,15 +234,24 @@ if "messages" not in st.session_state:
 
     intro=f"""'@' the politicians below and ask them questions (or demand answers😉)\n\n{names_and_shortcodes}\n\nYou can chat with individuals or setup interactions. The will always talk in the order they are '@'ed.\n\nExample usage:\n - @gw how do you feel about the "Big Gretch" nickname?\n- @dt @jb @dt @jb debate the merits of the 2022 election: was it stolen?\n- @aoc @aoc @aoc rap the green new deal to me.\n- @mtg @jdv @vr @mtg @jdv @vr tell me why you should be the future of the republican party\n- @bo if you ran for public office again, what position would it be?
     """
+    return intro
 
+PROFILES = get_profiles()
+
+#session state initialization
+if "messages" not in st.session_state:
     init_message = {
         "role": "Molus",
         "avatar": "🔺",
-        "content": intro
+        "content": get_intro()
     }
     st.session_state.messages = [
         init_message
     ]
+    #what the politicians see: an append-only, token-budgeted log of the conversation
+    st.session_state.context = ConversationContext(st.session_state.messages)
+    #turns are queued fairly across sessions by this id, see chain.TURN_POOL
+    st.session_state.session_id = uuid.uuid4().hex
 
 if __name__ == "__main__":
 
@@ -173,10 +267,16 @@ if __name__ == "__main__":
     for message in st.session_state.messages:
         display_message(message)
 
+    if TRACE_PANEL:
+        trace_panel = st.sidebar.empty()
+        display_trace_panel(trace_panel)
+
     if prompt := st.chat_input('Ask them anything...'):
 
         # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": prompt, 'avatar': USER_PROFILE_PIC})
+        user_message = {"role": "user", "content": prompt, 'avatar': USER_PROFILE_PIC}
+        st.session_state.messages.append(user_message)
+        st.session_state.context.append(user_message)
         # Display user message in chat message container
         with st.chat_message("user", avatar=USER_PROFILE_PIC):
             st.markdown(prompt)
@@ -186,19 +286,29 @@ if __name__ == "__main__":
         # Extract the instructions from the prompt
         prompt = re.sub(r"@(\w+)", "", prompt).strip()
 
+        unknown = [ code for code in mentions if code not in PROFILES ]
+        if len(unknown) > 0:
+            st.error(f"Unknown politician: {', '.join('@' + code for code in unknown)}")
+            st.stop()
+
         if len(mentions) > 0 and prompt != "":
 
-            #TODO add error handling for invalid shortcode
-            profiles = [ Profile(index=INDEX, shortcode=code) for code in mentions ]
+            profiles = [ PROFILES[code] for code in mentions ]
 
             # create chain from the profiles and prompt
             chain = Chain(
                 profiles=profiles,
-                prompt=prompt
+                prompt=prompt,
+                pipelined=True,
+                retrieval=RETRIEVAL_MODE,
+                session=st.session_state.session_id
             )
 
             # run the chain and display the results
             run_and_display_chain(chain)
+
+            if TRACE_PANEL:
+                display_trace_panel(trace_panel)
         
         else:
             st.error("Please '@' a politician to ask them a question or setup an interaction.")
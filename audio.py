@@ -0,0 +1,100 @@
+# Description: MP3 duration parsing and back-to-back playback scheduling
+import time
+
+#kbps by [version is MPEG1][layer][bitrate index]
+BITRATES = {
+    True: {
+        1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+        2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+        3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    },
+    False: {
+        1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+        2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    },
+}
+#Hz by version bits
+SAMPLE_RATES = {
+    0b11: [44100, 48000, 32000],
+    0b10: [22050, 24000, 16000],
+    0b00: [11025, 12000, 8000],
+}
+
+def parse_frame_header(header: bytes) -> tuple:
+    """returns (frame length in bytes, samples in frame, sample rate) for an MPEG audio frame header,
+    or None if header is not a valid frame header
+    """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (header[1] >> 3) & 0b11
+    layer_bits = (header[1] >> 1) & 0b11
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0b11
+    padding = (header[2] >> 1) & 0b1
+    if version_bits == 0b01 or layer_bits == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version_bits == 0b11
+    layer = 4 - layer_bits
+    bitrate = BITRATES[mpeg1][layer][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version_bits][sample_rate_index]
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or mpeg1 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+    return length, samples, sample_rate
+
+def get_mp3_duration(data: bytes) -> float:
+    """returns the exact duration in seconds of mp3 data by walking its frame headers.
+    Concatenated mp3 files (e.g. joined sentence segments) are handled too.
+    """
+    duration = 0.0
+    pos = 0
+    first_frame = True
+    while pos + 4 <= len(data):
+        #skip ID3v2 tags
+        if data[pos:pos+3] == b'ID3' and pos + 10 <= len(data):
+            size = (data[pos+6] << 21) | (data[pos+7] << 14) | (data[pos+8] << 7) | data[pos+9]
+            pos += 10 + size
+            first_frame = True
+            continue
+
+        frame = parse_frame_header(data[pos:pos+4])
+        if frame is None:
+            #resynchronize on the next possible frame header
+            pos = data.find(b'\xff', pos + 1)
+            if pos < 0:
+                break
+            continue
+
+        length, samples, sample_rate = frame
+        #a Xing/Info frame at the start of a file holds metadata, not audio
+        is_info = first_frame and (b'Xing' in data[pos:pos+64] or b'Info' in data[pos:pos+64])
+        if not is_info:
+            duration += samples / sample_rate
+        first_frame = False
+        pos += length
+    return duration
+
+class Timeline:
+    """schedules audio back to back on the wall clock, so each clip starts exactly when the previous one ends"""
+    def __init__(self):
+        self.end = time.time()
+
+    def remaining(self) -> float:
+        """seconds until the scheduled audio finishes"""
+        return max(0, self.end - time.time())
+
+    def is_free(self) -> bool:
+        return self.remaining() == 0
+
+    def play(self, duration: float):
+        """schedules a clip of duration seconds, starting now or when the current one ends"""
+        self.end = max(self.end, time.time()) + duration
+
+    def wait(self):
+        time.sleep(self.remaining())
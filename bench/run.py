@@ -0,0 +1,238 @@
+# Description: Microbenchmarks for the per-turn CPU hot paths, compared against a stored baseline
+#
+# usage: python bench/run.py --save-baseline    first, on the machine the benchmarks will be compared on
+#        python bench/run.py [--output results.json] [--baseline bench/baseline.json] [--threshold 1.25]
+#
+# Timings depend on the machine, so no baseline is committed: store one from the base revision
+# with --save-baseline, then run again on the change to compare against it.
+#
+# Every benchmark runs offline on local fixtures (setup/tests) and synthetic transcripts:
+# the knowledge base is queried against an in-memory stub index, with the query embedding pre-cached.
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'setup', 'tests')
+DEFAULT_BASELINE = os.path.join(ROOT, 'bench', 'baseline.json')
+
+#keep benchmark cache entries and spans out of the real caches and trace, and let setup/crawl.py import without credentials
+BENCH_DIR = tempfile.mkdtemp(prefix='liberate-bench-')
+os.environ['LIBERATE_CACHE_DIR'] = BENCH_DIR
+os.environ['TRACE_PATH'] = os.path.join(BENCH_DIR, 'trace.jsonl')
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'setup'))
+
+#each benchmark is timed in REPEATS rounds of enough calls to take at least ROUND_TIME seconds
+REPEATS = 5
+ROUND_TIME = 0.2
+#a benchmark regresses when its fastest round is slower than the baseline's by this factor.
+#The fastest round is the least disturbed by other load on the machine.
+REGRESSION_THRESHOLD = 1.25
+
+def load_fixture_snippets() -> list[dict]:
+    """returns the title, description and publish date of every video in the setup/tests search responses"""
+    snippets = []
+    for root, _, files in os.walk(FIXTURES):
+        for name in sorted(files):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(root, name)) as f:
+                data = json.load(f)
+            snippets.extend(item['snippet'] for item in data['items'])
+    return snippets
+
+def make_transcript(words: list[str], seconds: int, rng: random.Random) -> list[dict]:
+    """returns a synthetic youtube_transcript_api transcript of about one line every 3 seconds"""
+    transcript = []
+    start = 0.0
+    while start < seconds:
+        duration = rng.uniform(1.5, 4.5)
+        transcript.append({'text': ' '.join(rng.choices(words, k=rng.randint(6, 14))), 'start': start, 'duration': duration})
+        start += duration
+    return transcript
+
+def make_response(snippets: list[dict], rng: random.Random) -> str:
+    """returns a 100 word response citing quotes like the response model does"""
+    words = ' '.join(snippet['description'] or snippet['title'] for snippet in snippets).split()
+    sentences = []
+    for i in range(8):
+        sentence = ' '.join(rng.choices(words, k=12))
+        citations = ''.join(f'({n})' for n in rng.sample(range(1, 6), k=rng.randint(0, 2)))
+        sentences.append(f'{sentence} {citations}.')
+    return ' '.join(sentences)
+
+class StubIndex:
+    """in-memory stand-in for pinecone.Index with chains of chunks for one politician"""
+    def __init__(self, politician: str, snippets: list[dict], K: int):
+        from utils import NULL_ID
+        self.metadatas = {}
+        for i, snippet in enumerate(snippets):
+            ids = [ f'{i}-{j}' for j in range(3) ]
+            for j, id in enumerate(ids):
+                self.metadatas[id] = {
+                    'politician': politician,
+                    'video_id': f'video{i}',
+                    'timestamp': j * 30,
+                    'title': snippet['title'],
+                    'created': snippet['publishedAt'],
+                    'prev': ids[j-1] if j > 0 else NULL_ID,
+                    'next': ids[j+1] if j < 2 else NULL_ID,
+                    'transcript': f"{snippet['description']} {snippet['title']}" * 3
+                }
+        self.centers = [ f'{i}-1' for i in range(len(snippets)) ][:K]
+
+    def query(self, vector, top_k, include_metadata=True, filter=None) -> dict:
+        return {'matches': [
+            {'id': id, 'score': 0.9, 'metadata': self.metadatas[id]} for id in self.centers[:top_k]
+        ]}
+
+    def fetch(self, ids) -> dict:
+        return {'vectors': { id: {'id': id, 'metadata': self.metadatas[id]} for id in ids if id in self.metadatas }}
+
+def get_benchmarks() -> dict:
+    """returns benchmark name -> zero-argument callable. Benchmarks whose dependencies
+    are not installed are left out and reported as skipped.
+    """
+    rng = random.Random(0)
+    snippets = load_fixture_snippets()
+    words = ' '.join(snippet['title'] + ' ' + snippet['description'] for snippet in snippets).split()
+    benchmarks, skipped = {}, {}
+
+    #chunking a 20 minute video
+    from node import YTVideo
+    transcript = make_transcript(words, 20 * 60, rng)
+    benchmarks['ytvideo_chunking'] = lambda: YTVideo('Joe Biden', 'video', transcript, 'title', '2023-01-01')
+
+    #citation parsing of a response
+    from utils import extract_reference_numbers, strip_citations
+    response = make_response(snippets, rng)
+    benchmarks['extract_reference_numbers'] = lambda: extract_reference_numbers(response)
+    benchmarks['strip_citations'] = lambda: strip_citations(response)
+
+    #knowledge base query formatting and citation assembly
+    try:
+        from chain import PineconeKnowledgeBase
+        from utils import EMBEDDING_CACHE
+        K = 5
+        prompt = 'What did you say about the economy at the press conference?'
+        EMBEDDING_CACHE.put('text-embedding-ada-002', prompt, [ rng.random() for _ in range(1536) ])
+        kb = PineconeKnowledgeBase(index=StubIndex('Joe Biden', snippets, K), politician='Joe Biden')
+        benchmarks['kb_query_formatting'] = lambda: kb.query(prompt, K)
+    except ImportError as e:
+        skipped['kb_query_formatting'] = str(e)
+
+    #message reformatting and history selection for an 8 turn conversation,
+    #short enough to stay under SUMMARY_TRIGGER_TOKENS so no summary request is made
+    try:
+        from context import ConversationContext
+        messages = [{'role': 'Molus', 'content': 'intro'}]
+        for i in range(8):
+            messages.append({'role': 'user', 'content': ' '.join(rng.choices(words, k=20))})
+            messages.append({'role': 'Joe Biden', 'content': make_response(snippets, rng)})
+        def reformat():
+            context = ConversationContext(messages[:-1])
+            context.append(messages[-1])
+            return context.get_messages('gpt-4-0613')
+        benchmarks['message_reformatting'] = reformat
+    except ImportError as e:
+        skipped['message_reformatting'] = str(e)
+
+    #json extraction from a completion
+    try:
+        from crawl import YouTubeCrawler
+        fields = { 'videoIds': [ snippet['title'] for snippet in snippets[:10] ], 'relevant': True }
+        choice = {'text': f"\n\nHere are the results:\n{json.dumps(fields, indent=2)}\nLet me know if you need more."}
+        benchmarks['parse_gpt_choice'] = lambda: YouTubeCrawler.parse_gpt_choice(None, choice)
+    except (ImportError, KeyError) as e:
+        skipped['parse_gpt_choice'] = str(e)
+
+    return benchmarks, skipped
+
+def measure(fn) -> dict:
+    """returns per-call timings in microseconds"""
+    fn()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= ROUND_TIME:
+            break
+        number *= 2
+
+    rounds = [ elapsed / number ]
+    for _ in range(REPEATS - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - start) / number)
+    return {
+        'calls': number,
+        'min_us': round(min(rounds) * 1e6, 3),
+        'median_us': round(statistics.median(rounds) * 1e6, 3)
+    }
+
+def compare(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> list[dict]:
+    comparisons = []
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        ratio = result['min_us'] / base['min_us']
+        comparisons.append({'name': name, 'ratio': round(ratio, 3), 'regressed': ratio > threshold})
+    return comparisons
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', help='write results as json to this path')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='slowdown factor that counts as a regression')
+    args = parser.parse_args()
+
+    benchmarks, skipped = get_benchmarks()
+    results = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'benchmarks': {},
+        'skipped': skipped
+    }
+    for name, fn in benchmarks.items():
+        results['benchmarks'][name] = measure(fn)
+        print(f"{name:<28}{results['benchmarks'][name]['min_us']:>12.1f} us", file=sys.stderr)
+    for name, reason in skipped.items():
+        print(f'{name:<28}{"skipped":>12} ({reason})', file=sys.stderr)
+
+    regressed = False
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        results['comparison'] = compare(results, baseline, args.threshold)
+        for comparison in results['comparison']:
+            flag = ' REGRESSION' if comparison['regressed'] else ''
+            print(f"{comparison['name']:<28}{comparison['ratio']:>11.2f}x baseline{flag}", file=sys.stderr)
+        regressed = any(comparison['regressed'] for comparison in results['comparison'])
+    elif not args.save_baseline:
+        print(f'No baseline at {args.baseline}, nothing compared. Store one with --save-baseline first', file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(output)
+
+    sys.exit(1 if regressed else 0)
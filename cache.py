@@ -0,0 +1,244 @@
+# Description: Bounded in-memory and on-disk caches shared by the app and setup scripts
+import os
+import time
+import tempfile
+import numpy as np
+from array import array
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+from cachetools import LRUCache
+
+#Root for on-disk caches, shared by the app and the setup scripts
+CACHE_DIR = os.environ.get('LIBERATE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'))
+
+def hash_key(*parts) -> str:
+    return sha256('\0'.join(str(part) for part in parts).encode()).hexdigest()
+
+class DiskCache:
+    """directory of files named by key, evicted least recently used first once max_bytes is exceeded.
+    Writes go to a temporary file that is atomically renamed into place, so several
+    processes can share one directory without ever reading a partial entry.
+    """
+    TMP_PREFIX = '.tmp-'
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        os.makedirs(path, exist_ok=True)
+
+        #key -> size, least recently used first
+        entries = []
+        for name in os.listdir(path):
+            if name.startswith(self.TMP_PREFIX):
+                continue
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        entries.sort()
+        self.sizes = OrderedDict((name, size) for _, name, size in entries)
+        self.total_bytes = sum(self.sizes.values())
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self.get_path(key))
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def get(self, key: str) -> bytes:
+        """returns the cached bytes for key, or None"""
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            #touch so other processes see the entry as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.forget(key)
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+            if key not in self.sizes:
+                self.total_bytes += len(data)
+            self.sizes[key] = len(data)
+            self.sizes.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(prefix=self.TMP_PREFIX, dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.get_path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self.lock:
+            self.forget(key)
+            self.sizes[key] = len(data)
+            self.total_bytes += len(data)
+            self.evict()
+
+    def forget(self, key: str):
+        size = self.sizes.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.sizes) > 1:
+            key, size = self.sizes.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.get_path(key))
+            except FileNotFoundError:
+                pass
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups > 0 else 0,
+                'bytes': self.total_bytes
+            }
+
+class EmbeddingCache:
+    """two-tier cache of embeddings keyed by (model, text hash): an in-process LRU in front of a DiskCache.
+    Both tiers store embeddings as raw float32 bytes, and the in-process tier holds at most memory_bytes of them.
+    """
+    def __init__(self, path: str, max_bytes: int, memory_bytes: int = 16 * 1024 * 1024):
+        self.memory = LRUCache(maxsize=memory_bytes, getsizeof=len)
+        self.disk = DiskCache(path, max_bytes)
+        self.lock = Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, model: str, text: str) -> list:
+        """returns the cached embedding, or None"""
+        key = hash_key(model, text)
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory_hits += 1
+                return array('f', data).tolist()
+
+        data = self.disk.get(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.memory[key] = data
+            self.disk_hits += 1
+        return array('f', data).tolist()
+
+    def put(self, model: str, text: str, embedding: list):
+        key = hash_key(model, text)
+        data = array('f', embedding).tobytes()
+        with self.lock:
+            self.memory[key] = data
+        self.disk.put(key, data)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hit_rate = (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round(hit_rate, 3),
+                'memory_bytes': self.memory.currsize,
+                'disk_bytes': self.disk.total_bytes
+            }
+
+class ResponseCache:
+    """in-process cache of complete responses. Entries are bucketed by an exact key and matched by
+    prompt embedding within a cosine similarity threshold, so near-duplicate prompts share a response.
+    Entries expire after ttl seconds and are evicted least recently used first once max_bytes is exceeded.
+    """
+    def __init__(self, threshold: float, ttl: float, max_bytes: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.buckets = {}
+        self.total_bytes = 0
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, embedding: list) -> dict:
+        """returns a copy of the closest cached response for key, or None"""
+        xq = normalize(embedding)
+        now = time.time()
+        with self.lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self.buckets.get(key, ())):
+                entry = self.entries[entry_id]
+                if entry['expires'] < now:
+                    self.remove(entry_id)
+                    continue
+                score = float(np.dot(entry['embedding'], xq))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best_id)
+            return dict(self.entries[best_id]['response'])
+
+    def put(self, key: tuple, embedding: list, response: dict):
+        size = len(response.get('audio') or b'') + len(response.get('content') or '')
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = {
+                'key': key,
+                'embedding': normalize(embedding),
+                'response': dict(response),
+                'size': size,
+                'expires': time.time() + self.ttl
+            }
+            self.buckets.setdefault(key, []).append(entry_id)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, entry_id: int):
+        entry = self.entries.pop(entry_id)
+        self.total_bytes -= entry['size']
+        bucket = self.buckets[entry['key']]
+        bucket.remove(entry_id)
+        if len(bucket) == 0:
+            del self.buckets[entry['key']]
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups > 0 else 0,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes
+            }
+
+def normalize(embedding: list) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
@@ -1,31 +1,153 @@
+import asyncio
+import contextlib
+import os
 import time
+import re
 import openai
 import json
+import aiohttp
 import streamlit as st
-from elevenlabs import generate, Voice
+import aio
+from elevenlabs.api.base import api_base_url_v1
 from politicians import POLITICIANS, get_politician_by_shortcode
-from utils import is_null, extract_reference_numbers, NULL_ID, get_embedding, strip_citations
+from queue import Queue
+from threading import Lock, Event
+from cachetools import LRUCache
+from concurrent.futures import Future
+from cache import CACHE_DIR, DiskCache, ResponseCache, hash_key
+from context import ConversationContext, ChainContext, count_tokens
+from tracing import span, get_current_span
+from resilience import call, acall, CircuitOpenError
+from lexical import fuse_rankings
+from vectorstore import VectorIndex
+from pool import FairPool, Coalescer, OverloadedError
+from utils import is_null, extract_reference_numbers, NULL_ID, aget_embedding, strip_citations, split_sentences
+
+#Metadata of indexed chunks, keyed by chunk id. Shared by all knowledge bases in the process.
+CHUNK_CACHE_SIZE = 4096
+CHUNK_CACHE = LRUCache(maxsize=CHUNK_CACHE_SIZE)
+CHUNK_CACHE_LOCK = Lock()
+
+#Sentences are synthesized as soon as they are generated, up to TTS_CONCURRENCY at a time per turn,
+#so one long turn never queues ahead of another session's first sentence. The provider's overall
+#rate limit is enforced by resilience.
+#Short sentences are merged so each request has enough text for natural prosody.
+TTS_CONCURRENCY = 3
+TTS_MODEL = "eleven_monolingual_v1"
+MIN_SENTENCE_LENGTH = 40
+
+#Synthesized audio keyed by voice, model, voice settings and text, shared by every session on this machine
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get('AUDIO_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+AUDIO_CACHE = DiskCache(os.path.join(CACHE_DIR, 'audio'), max_bytes=AUDIO_CACHE_MAX_BYTES)
+
+#Complete responses (text, citations and audio) for near-duplicate prompts in the same context.
+#A prompt matches when its embedding is within RESPONSE_CACHE_THRESHOLD cosine similarity of a
+#cached one for the same politician and the same last RESPONSE_CACHE_HISTORY_TURNS messages.
+RESPONSE_CACHE_THRESHOLD = float(os.environ.get('RESPONSE_CACHE_THRESHOLD', 0.97))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 24 * 60 * 60))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+RESPONSE_CACHE_HISTORY_TURNS = 2
+RESPONSE_CACHE = ResponseCache(
+    threshold=RESPONSE_CACHE_THRESHOLD,
+    ttl=RESPONSE_CACHE_TTL,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES
+)
+
+#At most MAX_ACTIVE_TURNS turns are generated at once across all sessions. Up to MAX_WAITING_TURNS more
+#wait for a slot, served round robin by session, at most MAX_WAITING_TURNS_PER_SESSION of them from one
+#session. Turns beyond that fail at once with pool.OverloadedError instead of piling up upstream calls.
+MAX_ACTIVE_TURNS = int(os.environ.get('MAX_ACTIVE_TURNS', 8))
+MAX_WAITING_TURNS = int(os.environ.get('MAX_WAITING_TURNS', 32))
+MAX_WAITING_TURNS_PER_SESSION = 2
+TURN_POOL = FairPool(MAX_ACTIVE_TURNS, MAX_WAITING_TURNS, MAX_WAITING_TURNS_PER_SESSION)
+
+#Identical concurrent knowledge base queries and speech syntheses share a single upstream call
+KB_QUERIES = Coalescer()
+TTS_REQUESTS = Coalescer()
+
+#Hybrid search fuses the top HYBRID_CANDIDATES * K chunks of each ranking
+HYBRID_CANDIDATES = 2
+
+#How the knowledge base query is built for each turn:
+#  'llm' asks gpt-3.5 to generate a question from the conversation
+#  'local' builds it from the user's prompt and the last RETRIEVAL_TURNS turns, skipping an LLM call
+#  'compare' retrieves with both, answers with 'llm', and logs how many retrieved chunks they share
+RETRIEVAL_MODES = ('llm', 'local', 'compare')
+RETRIEVAL_TURNS = 2
+RETRIEVAL_LOG_PATH = os.environ.get('RETRIEVAL_LOG_PATH', 'retrieval_log.jsonl')
+
+QUESTION_MODEL = "gpt-3.5-turbo-16k-0613"
+RESPONSE_MODEL = "gpt-4-0613"
+#Completion tokens reserved against the rate limit for a response of about 100 words
+RESPONSE_COMPLETION_TOKENS = 200
+
+#Errors that mean the OpenAI API could not produce a response for this turn, after retries
+API_ERRORS = (
+    openai.error.ServiceUnavailableError,
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    CircuitOpenError,
+    json.decoder.JSONDecodeError
+)
+
+class SpeechError(Exception):
+    """ElevenLabs could not synthesize a sentence, after retries"""
+
+def log_retrieval_overlap(politician: str, llm_query: str, llm_citations: list, local_query: str, local_citations: list):
+    llm_urls = { url for _, url in llm_citations }
+    local_urls = { url for _, url in local_citations }
+    overlap = len(llm_urls & local_urls) / len(llm_urls) if len(llm_urls) > 0 else 0
+    print(f'Retrieval overlap for {politician}: {overlap:.2f}')
+    with open(RETRIEVAL_LOG_PATH, 'a') as f:
+        f.write(json.dumps({
+            'politician': politician,
+            'llm_query': llm_query,
+            'local_query': local_query,
+            'llm_chunks': sorted(llm_urls),
+            'local_chunks': sorted(local_urls),
+            'overlap': overlap
+        }) + '\n')
 
 class PineconeKnowledgeBase:
-    def __init__(self, index, politician: str):
-        #TODO: setup index init and such
+    def __init__(self, index: VectorIndex, politician: str, lexical=None, chunks=None):
+        #index is a pinecone.Index or a vectorstore.LocalIndex
         self.politician = politician
         self.index = index
+        #optional lexical.LexicalIndex. When given, queries are hybrid: BM25 and vector rankings
+        #are fused, and keyword-heavy queries are answered by BM25 alone without an embedding call
+        self.lexical = lexical
+        #optional chunkstore.ChunkStore. When given, the index only returns ids and scores,
+        #and chunk text and neighbours are read locally instead of from index metadata
+        self.chunks = chunks
+
+    def get_index_politician(self) -> str:
+        """returns the politician's name as spelled in the index metadata"""
+        if self.politician == "Barack Obama":
+            return "Barrack Obama"
+        elif self.politician == "J.D. Vance":
+            return "James David Vance"
+        return self.politician
 
     def query(self, prompt, K) -> tuple:
         """returns formatted response from pinecone index and the citations used
         """
+        return aio.run(self.aquery(prompt, K))
 
-        #recursive query
-        xq = get_embedding(prompt)
-        politician = self.politician
-        if self.politician == "Barack Obama":
-            politician = "Barrack Obama"
-        elif self.politician == "J.D. Vance":
-            politician = "James David Vance"
+    async def aquery(self, prompt, K) -> tuple:
+        """async version of query. Index calls run in a worker thread, since the
+        pinecone client is blocking (it keeps its own pool of keep-alive connections).
+        Identical queries in flight at the same time, from any session, share one search.
+        """
 
-        res = self.index.query(vector=xq, top_k=K, include_metadata=True, filter={'politician': politician})
-        matches = res['matches']
+        with span('kb_query', politician=self.politician, K=K) as kb_span:
+            formatted_context, citations = await KB_QUERIES.run((self.politician, id(self.index), prompt, K), self.aretrieve, prompt, K)
+            kb_span.set(context_chars=len(formatted_context))
+            return (formatted_context, citations)
+
+    async def aretrieve(self, prompt, K) -> tuple:
+        """searches, fetches and formats the chunks for aquery"""
+        matches = await self.asearch(prompt, K)
         # [ prev_1, id_1, next_1 ]
         # [ prev_2, id_2, next_2 ]
         # [... for k queries ]
@@ -37,12 +159,11 @@ class PineconeKnowledgeBase:
             ] for item in matches
         ]
 
-        fetch_response = [ self.index.fetch(ids=node_ids) for node_ids in query_nodes ]
-        query_vectors = [ res['vectors'] for res in fetch_response ]
+        #one batched fetch for the union of all prev/next chunks
+        node_ids = [ id for node_set in query_nodes for id in node_set ]
+        metadatas = await self.afetch(node_ids)
         query_metadatas = [
-            [
-                query_vectors[i][id]['metadata'] if not is_null(id) else NULL_ID for id in node_set
-            ] for i, node_set in enumerate(query_nodes)
+            [ metadatas[id] for id in node_set ] for node_set in query_nodes
         ]
 
         #formatting
@@ -72,18 +193,95 @@ class PineconeKnowledgeBase:
             citations.append((number, url))
 
         # print('Citations:', citations)
-        
+
         return (formatted_context, citations)
 
+    async def asearch(self, prompt, K) -> list[dict]:
+        """returns the K best chunks for prompt as [{'id', 'metadata'}, ...]"""
+        politician = self.get_index_politician()
+        if self.lexical is None:
+            matches = await self.avector_search(prompt, K, politician)
+            if self.chunks is None:
+                return matches
+            ids = [ item['id'] for item in matches ]
+        else:
+            ids = await self.ahybrid_search(prompt, K, politician)
+
+        metadatas = await self.afetch(ids)
+        return [ {'id': id, 'metadata': metadatas[id]} for id in ids ]
+
+    async def ahybrid_search(self, prompt, K, politician: str) -> list[str]:
+        with span('lexical_query') as lexical_span:
+            lexical_ids = [ id for id, _ in self.lexical.query(prompt, HYBRID_CANDIDATES * K, politician) ]
+            keyword = len(lexical_ids) >= K and self.lexical.is_keyword_query(prompt, politician)
+            lexical_span.set(matches=len(lexical_ids), keyword=keyword)
+        if keyword:
+            ids = lexical_ids[:K]
+        else:
+            vector_matches = await self.avector_search(prompt, HYBRID_CANDIDATES * K, politician)
+            ids = fuse_rankings([[ item['id'] for item in vector_matches ], lexical_ids], K)
+        return ids
+
+    async def avector_search(self, prompt, K, politician: str) -> list[dict]:
+        xq = await aget_embedding(prompt)
+        include_metadata = self.chunks is None
+        with span('index_query', top_k=K, include_metadata=include_metadata) as query_span:
+            res = await asyncio.to_thread(call, 'pinecone', 'v1', self.index.query, vector=xq, top_k=K, include_metadata=include_metadata, filter={'politician': politician})
+            matches = res['matches']
+            query_span.set(matches=len(matches))
+        if not include_metadata:
+            return matches
+
+        #chunks are immutable once indexed, so the metadata from the query can be cached
+        with CHUNK_CACHE_LOCK:
+            for item in matches:
+                CHUNK_CACHE[item['id']] = item['metadata']
+        return matches
+
+    def fetch(self, ids: list[str]) -> dict:
+        """returns chunk metadatas keyed by id. Null ids map to NULL_ID.
+        Uncached ids are fetched from the index in a single batch, or read from the
+        chunk store together with their neighbours, which are cached for the follow-up lookup.
+        """
+        return aio.run(self.afetch(ids))
+
+    async def afetch(self, ids: list[str]) -> dict:
+        with span('fetch', ids=len(ids)) as fetch_span:
+            metadatas = {}
+            missing = set()
+            with CHUNK_CACHE_LOCK:
+                for id in ids:
+                    if is_null(id):
+                        metadatas[id] = NULL_ID
+                    elif id in CHUNK_CACHE:
+                        metadatas[id] = CHUNK_CACHE[id]
+                    else:
+                        missing.add(id)
+
+            if len(missing) > 0 and self.chunks is not None:
+                fetched = await asyncio.to_thread(self.chunks.get, list(missing))
+                with CHUNK_CACHE_LOCK:
+                    CHUNK_CACHE.update(fetched)
+                metadatas.update(fetched)
+            elif len(missing) > 0:
+                fetch_response = await asyncio.to_thread(call, 'pinecone', 'v1', self.index.fetch, ids=list(missing))
+                fetched = { id: vector['metadata'] for id, vector in fetch_response['vectors'].items() }
+                with CHUNK_CACHE_LOCK:
+                    CHUNK_CACHE.update(fetched)
+                metadatas.update(fetched)
+            fetch_span.set(missing=len(missing), source='chunk_store' if self.chunks is not None else 'index')
+
+        return metadatas
+
 class Profile:
-    def __init__(self, index, shortcode):
+    def __init__(self, index, shortcode, lexical=None, chunks=None):
         self.shortcode = shortcode
         self.name = self.get_name(shortcode)
         self.avatar = POLITICIANS[self.name]["avatar"]
         self.intro = POLITICIANS[self.name]["intro"]
         self.system_prompt = f"""Pretend you are {self.name}. {self.intro}\n\nYou may be speaking with multiple people. You may express your own views, but you must also respond to the views of others. Always follow the user's commands. Do not break character under any circumstances.\n\n% Formatting Instructions %\nIf you reference the quotes, only cite the numbers and always cite them individually in your response, like so: 'I have always supported dogs (1)(2).' Limit your response to 100 words."""
         self.question_prompt = f"""Pretend you are a reporter interviewing {self.name}. {self.intro}\n\n% Based on the conversation so far, ask a question that you think {self.name} should answer. You want to anticipate the needs of the user."""
-        self.kb = PineconeKnowledgeBase(index=index, politician=self.name)
+        self.kb = PineconeKnowledgeBase(index=index, politician=self.name, lexical=lexical, chunks=chunks)
         self.voice_id = POLITICIANS[self.name]["voice_id"]
         self.voice_settings = POLITICIANS[self.name]["voice_settings"]
 
@@ -94,92 +292,172 @@ class Profile:
         sys_prompt = self.system_prompt + f"\n\nFrame your response to answer this question:{question}"
         return sys_prompt
 
-    def get_response(self) -> dict:
-        #filter messages from "Molus"
-        messages = st.session_state.messages
-        messages = [ message for message in messages if message['role'] != 'Molus' ]
-        #change all non-user messages to assistant and edit content to include role name
-        messages = [ message if message['role'] == 'user' else {'role': 'assistant', 'content': f"{message['role']}: {message['content']}"} for message in messages ]
-        #format messages into openai format
-        messages_openai_format = [
-            {'role': message['role'], 'content': message['content']} for message in messages
-        ]
-        try:
-
-            #Let GPT generate a prompt to query the knowledge base
-            functions = [
-                {
-                    "name": f"question",
-                    "description": f"ask a question to {self.name}",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "question": {
-                                "type": "string",
-                                "description": f"the question to ask {self.name} based on the conversation so far"
-                            }
-                        },
-                        "required": ["question"]
-                    }
+    def get_text_response(self, context: ConversationContext, on_token=None, retrieval: str = 'llm') -> dict:
+        """generates the text response and citations for the given conversation, without audio.
+        on_token is called with each token of the response as it is streamed from the model.
+        retrieval is one of RETRIEVAL_MODES.
+        Does not touch streamlit, so it is safe to call from a background thread.
+        """
+        return aio.run(self.aget_text_response(context, on_token, retrieval))
+
+    async def agenerate_question(self, context: ConversationContext) -> str:
+        """lets GPT generate a question to query the knowledge base"""
+        functions = [
+            {
+                "name": f"question",
+                "description": f"ask a question to {self.name}",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "question": {
+                            "type": "string",
+                            "description": f"the question to ask {self.name} based on the conversation so far"
+                        }
+                    },
+                    "required": ["question"]
                 }
-            ]
-
-            question_prompt = {
-                "role": "system",
-                "content": self.question_prompt
             }
-            chat_history = [question_prompt] + messages_openai_format
+        ]
+
+        question_prompt = {
+            "role": "system",
+            "content": self.question_prompt
+        }
+        chat_history = [question_prompt] + context.get_messages(QUESTION_MODEL)
 
-            init_response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo-16k-0613",
+        with span('question') as question_span:
+            init_response = await acall(
+                'openai', QUESTION_MODEL, openai.ChatCompletion.acreate,
+                model=QUESTION_MODEL,
                 messages=chat_history,
                 functions=functions,
-                function_call = {"name": f"question"}
+                function_call = {"name": f"question"},
+                tokens=sum(count_tokens(message["content"]) for message in chat_history)
             )
-            message = init_response["choices"][0]["message"]
-            function_name = message["function_call"]["name"]
-            function_args = json.loads(message["function_call"]["arguments"])
-            query = function_args["question"]  
-
-            print('Getting quotes for', self.name)
-            print('GPT generated query:', query)
-
-            #Query the knowledge base
-            K = 5
-            kb_response, all_citations = self.kb.query(query, K)
-
-            # print('KB response:', kb_response)
-            system_prompt = {
-                "role": "system",
-                "content": self.get_system_prompt(query)
-            }
-            chat_history = [system_prompt] + messages_openai_format
-
-            print('Generating response for', self.name)
-            print('Chat history:', chat_history)
-
-            #Generate a response based on the knowledge base
-            response = openai.ChatCompletion.create(
-                model="gpt-4-0613",
-                messages=chat_history+[
-                    {
-                        "role": "function",
-                        "name": function_name,
-                        "content": kb_response,
-                    },
-                ],
+            usage = init_response["usage"]
+            question_span.meter(QUESTION_MODEL, usage["prompt_tokens"], usage["completion_tokens"])
+        message = init_response["choices"][0]["message"]
+        function_args = json.loads(message["function_call"]["arguments"])
+        return function_args["question"]
+
+    def get_user_prompt(self, context: ConversationContext) -> str:
+        """returns the latest user prompt, without mentions"""
+        return re.sub(r"@(\w+)", "", context.get_user_prompt()).strip()
+
+    def get_retrieval_query(self, prompt: str, context: ConversationContext) -> str:
+        """builds a knowledge base query locally, without an LLM call, from the user's prompt,
+        the last few turns and the politician's name
+        """
+        turns = [
+            strip_citations(message['content'])
+            for message in context.get_recent(RETRIEVAL_TURNS) if message['role'] != 'user'
+        ]
+        return '\n'.join([f"{self.name}, {prompt}"] + turns)
+
+    def get_history_fingerprint(self, context: ConversationContext) -> str:
+        """hashes the last few messages before this turn, leaving out the latest user prompt,
+        which the response cache matches by embedding instead
+        """
+        history = context.get_recent(RESPONSE_CACHE_HISTORY_TURNS + 1)
+        prompts = [ i for i, message in enumerate(history) if message['role'] == 'user' ]
+        if len(prompts) > 0:
+            del history[prompts[-1]]
+        recent = history[-RESPONSE_CACHE_HISTORY_TURNS:]
+        return hash_key(*[ f"{message['role']}: {message['content']}" for message in recent ])
+
+    async def aget_cached_response(self, context: ConversationContext) -> tuple:
+        """returns the response cache key for this turn and the cached response, or None"""
+        embedding = await aget_embedding(self.get_user_prompt(context))
+        key = (self.shortcode, self.get_history_fingerprint(context))
+        with span('response_cache') as cache_span:
+            cached = RESPONSE_CACHE.get(key, embedding)
+            cache_span.set(cache_hit=cached is not None, hit_rate=RESPONSE_CACHE.get_stats()['hit_rate'])
+        return (key, embedding), cached
+
+    async def acache_response(self, cache_key: tuple, response: dict, segments: list):
+        """stores the response once all of its audio segments are synthesized"""
+        try:
+            audio = await asyncio.gather(*[ asyncio.wrap_future(segment) for segment in segments ])
+        except Exception:
+            return
+        key, embedding = cache_key
+        RESPONSE_CACHE.put(key, embedding, {**response, "audio": b''.join(audio)})
+
+    async def aget_text_response(self, context: ConversationContext, on_token=None, retrieval: str = 'llm') -> dict:
+        question, kb_response, all_citations = await self.aprepare_response(context, retrieval)
+        return await self.astream_response(context, question, kb_response, all_citations, on_token)
+
+    async def aprepare_response(self, context: ConversationContext, retrieval: str = 'llm') -> tuple:
+        """returns the question to answer, the formatted knowledge base response and its citations"""
+        aio.get_session()
+        K = 5
+
+        if retrieval == 'local':
+            question = self.get_user_prompt(context)
+            query = self.get_retrieval_query(question, context)
+        else:
+            if retrieval == 'compare':
+                local_query = self.get_retrieval_query(self.get_user_prompt(context), context)
+                local_kb_query = asyncio.create_task(self.kb.aquery(local_query, K))
+            query = question = await self.agenerate_question(context)
+
+        print('Getting quotes for', self.name)
+        print(f'{retrieval} retrieval query:', query)
+
+        #Query the knowledge base
+        kb_response, all_citations = await self.kb.aquery(query, K)
+
+        if retrieval == 'compare':
+            _, local_citations = await local_kb_query
+            log_retrieval_overlap(self.name, query, all_citations, local_query, local_citations)
+
+        return question, kb_response, all_citations
+
+    async def astream_response(self, context: ConversationContext, question: str, kb_response: str, all_citations: list, on_token=None) -> dict:
+        """generates the response to question from the knowledge base response, streaming its tokens to on_token"""
+        # print('KB response:', kb_response)
+        system_prompt = {
+            "role": "system",
+            "content": self.get_system_prompt(question)
+        }
+        chat_history = [system_prompt] + context.get_messages(RESPONSE_MODEL)
+
+        print('Generating response for', self.name)
+        print('Chat history:', chat_history)
+
+        #Generate a response based on the knowledge base
+        messages = chat_history+[
+            {
+                "role": "function",
+                "name": "question",
+                "content": kb_response,
+            },
+        ]
+        prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+        with span('response') as response_span:
+            response = await acall(
+                'openai', RESPONSE_MODEL, openai.ChatCompletion.acreate,
+                model=RESPONSE_MODEL,
+                messages=messages,
+                stream=True,
+                tokens=prompt_tokens + RESPONSE_COMPLETION_TOKENS
             )
 
-        except openai.error.ServiceUnavailableError:
-            st.error("OpenAI API is currently unavailable. Please try again later.")
-            st.stop()
+            tokens = []
+            async for chunk in response:
+                token = chunk["choices"][0]["delta"].get("content")
+                if token:
+                    if len(tokens) == 0:
+                        response_span.set(first_token_ms=round((time.time() - response_span.start) * 1000, 3))
+                    tokens.append(token)
+                    if on_token is not None:
+                        on_token(token)
 
-        except json.decoder.JSONDecodeError:
-            st.error("OpenAI API is currently unavailable. Please try again later.")
-            st.stop()
+            #streamed completions carry no usage, so tokens are estimated from the text
+            response_span.meter(RESPONSE_MODEL, prompt_tokens, count_tokens(''.join(tokens)), estimated=True)
 
         # return response and citations
-        response_text = response.choices[0]["message"]["content"]
+        response_text = ''.join(tokens)
 
         #strip name from response
         response_text = response_text.replace(f"{self.name}:", "")
@@ -189,27 +467,242 @@ class Profile:
         used_citations = [ citation for citation in all_citations if citation[0] in used_numbers ]
         citations = list(zip(*used_citations))
 
-        #generate audio response
-        to_speak = strip_citations(response_text)
-        audio_response = generate(
-            text=to_speak,
-            voice=Voice(voice_id=self.voice_id, settings=self.voice_settings)
-        )
-
         return {
             "role": self.name,
             "shortcode": self.shortcode,
             "avatar": self.avatar,
             "content": response_text,
             "citations": citations,
-            "audio": audio_response
         }
 
+    def get_audio_response(self, response_text: str) -> bytes:
+        return aio.run(self.aget_audio_response(response_text))
+
+    async def aget_audio_response(self, response_text: str, semaphore: asyncio.Semaphore = None) -> bytes:
+        """synthesizes response_text, holding semaphore if given while the request is made"""
+        #generate audio response
+        with span('tts', voice=self.voice_id) as tts_span:
+            to_speak = strip_citations(response_text)
+            settings = json.dumps(self.voice_settings.model_dump(), sort_keys=True)
+            key = hash_key(self.voice_id, TTS_MODEL, settings, to_speak)
+            audio_response = AUDIO_CACHE.get(key)
+            tts_span.set(characters=len(to_speak), cache_hit=audio_response is not None)
+            if audio_response is not None:
+                tts_span.set(bytes=len(audio_response))
+                return audio_response
+
+            url = f"{api_base_url_v1}/text-to-speech/{self.voice_id}"
+            data = {
+                "text": to_speak,
+                "model_id": TTS_MODEL,
+                "voice_settings": self.voice_settings.model_dump()
+            }
+            headers = {"xi-api-key": os.environ.get("ELEVENLABS_API_KEY")}
+
+            async def synthesize() -> bytes:
+                async with semaphore or contextlib.nullcontext():
+                    async with aio.get_session().post(url, json=data, headers=headers) as response:
+                        response.raise_for_status()
+                        return await response.read()
+
+            async def generate() -> bytes:
+                audio = await acall('elevenlabs', TTS_MODEL, synthesize)
+                AUDIO_CACHE.put(key, audio)
+                return audio
+
+            try:
+                audio_response = await TTS_REQUESTS.run(key, generate)
+            except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+                raise SpeechError(str(e)) from e
+            tts_span.set(bytes=len(audio_response))
+        return audio_response
+
+    def get_response(self, messages: list[dict] = None) -> dict:
+        if messages is None:
+            context = st.session_state.context
+        else:
+            context = ConversationContext(messages, summarize=False)
+        try:
+            return aio.run(self.aget_response(context, st.session_state.get('session_id')))
+
+        except API_ERRORS:
+            st.error("OpenAI API is currently unavailable. Please try again later.")
+            st.stop()
+
+        except SpeechError:
+            st.error("ElevenLabs text to speech is currently unavailable. Please try again later.")
+            st.stop()
+
+        except OverloadedError:
+            st.warning("Too many conversations are running right now. Please try again in a minute.")
+            st.stop()
+
+    async def aget_response(self, context: ConversationContext, session: str = None) -> dict:
+        """returns a cached response, or generates the full response in a slot of TURN_POOL,
+        queued fairly with other sessions' turns
+        """
+        with span('turn', politician=self.name, retrieval='llm') as turn_span:
+            cache_key, cached, response = await self.alookup_or_generate(context, session)
+            turn_span.set(cache_hit=cached is not None)
+            if cached is not None:
+                return cached
+            response["audio"] = await self.aget_audio_response(response["content"])
+            key, embedding = cache_key
+            RESPONSE_CACHE.put(key, embedding, response)
+            return response
+
+    async def alookup_or_generate(self, context: ConversationContext, session: str = None, on_token=None, retrieval: str = 'llm') -> tuple:
+        """looks up the response cache while the turn waits for a slot in TURN_POOL and prepares its
+        knowledge base response, so a miss costs no extra round trip. The response is only streamed
+        once the cache has missed, and the rest is cancelled on a hit.
+        returns the cache key, the cached response or None, and the generated text response or None
+        """
+        lookup = asyncio.create_task(self.aget_cached_response(context))
+
+        async def agenerate():
+            queued = time.time()
+            async with TURN_POOL.slot(session):
+                turn_span = get_current_span()
+                if turn_span is not None:
+                    turn_span.set(queued_ms=round((time.time() - queued) * 1000, 3))
+                prepared = await self.aprepare_response(context, retrieval)
+                _, cached = await asyncio.shield(lookup)
+                if cached is not None:
+                    return None
+                return await self.astream_response(context, *prepared, on_token=on_token)
+
+        generation = asyncio.create_task(agenerate())
+        try:
+            cache_key, cached = await lookup
+        except BaseException:
+            generation.cancel()
+            raise
+        if cached is not None:
+            generation.cancel()
+            #wait for the slot to be released, and drop an OverloadedError the hit made moot
+            await asyncio.gather(generation, return_exceptions=True)
+            return cache_key, cached, None
+        return cache_key, None, await generation
+
+class Turn:
+    """a profile's response in progress. The response is generated in a background thread;
+    its tokens can be consumed from the script thread as they arrive, and each sentence
+    is synthesized as soon as it is complete so playback can start after the first one.
+    """
+    def __init__(self, profile: Profile, retrieval: str = 'llm', session: str = None):
+        self.profile = profile
+        self.retrieval = retrieval
+        self.session = session
+        #limits this turn's concurrent synthesis requests
+        self.tts = asyncio.Semaphore(TTS_CONCURRENCY)
+        self.tokens = Queue()
+        self.streaming = True
+        self.done = Event()
+        self.response = None
+        self.segments = []
+        self.error = None
+
+    async def generate(self, context: ChainContext) -> bool:
+        """generates the text response, scheduling each sentence's audio synthesis as soon as it is complete,
+        and appends it to the chain's context before the turn is done.
+        The response cache is looked up while the turn waits for a slot in TURN_POOL and prepares its response.
+        Cached responses are returned at once; on a miss, the turn fails with OverloadedError if the pool's queue is full.
+        returns whether the text was generated successfully
+        """
+        unfinished = ''
+
+        def on_token(token):
+            nonlocal unfinished
+            self.tokens.put(token)
+            sentences, unfinished = split_sentences(unfinished + token, MIN_SENTENCE_LENGTH)
+            for sentence in sentences:
+                self.speak(sentence)
+
+        with span('turn', politician=self.profile.name, retrieval=self.retrieval) as turn_span:
+            try:
+                cache_key, cached, response = await self.profile.alookup_or_generate(context, self.session, on_token, self.retrieval)
+                turn_span.set(cache_hit=cached is not None)
+                if cached is not None:
+                    self.tokens.put(cached["content"])
+                    audio = Future()
+                    audio.set_result(cached.pop("audio"))
+                    self.segments.append(audio)
+                    self.response = cached
+                else:
+                    self.response = response
+                    self.speak(unfinished)
+                    aio.submit(self.profile.acache_response(cache_key, self.response, list(self.segments)))
+                context.append(self.response)
+            except Exception as e:
+                self.error = e
+                turn_span.set(error=type(e).__name__)
+            finally:
+                self.tokens.put(None)
+                self.done.set()
+        return self.error is None
+
+    def speak(self, sentence: str):
+        sentence = sentence.replace(f"{self.profile.name}:", "")
+        if strip_citations(sentence).strip() == "":
+            return
+        self.segments.append(aio.submit(self.profile.aget_audio_response(sentence, self.tts)))
+
+    def fail(self, error: Exception):
+        self.error = error
+        self.tokens.put(None)
+        self.done.set()
+
+    def stream(self):
+        """yields the tokens of the response as they are generated"""
+        while (token := self.tokens.get()) is not None:
+            yield token
+        self.streaming = False
+        if self.error is not None:
+            raise self.error
+
+    def poll(self) -> list[str]:
+        """returns the tokens generated since the last call, without blocking.
+        streaming is False once the response is complete
+        """
+        tokens = []
+        while self.streaming and not self.tokens.empty():
+            token = self.tokens.get()
+            if token is None:
+                self.streaming = False
+                if self.error is not None:
+                    raise self.error
+            else:
+                tokens.append(token)
+        return tokens
+
+    def get_segment(self, i: int) -> bytes:
+        """returns the audio of the i-th sentence, or None if it is not synthesized yet"""
+        if i >= len(self.segments) or not self.segments[i].done():
+            return None
+        return self.segments[i].result()
+
+    def is_spoken(self, i: int) -> bool:
+        """whether all sentences before the i-th have been handed out"""
+        return self.done.is_set() and i >= len(self.segments)
+
+    def result(self) -> dict:
+        """returns the full response with citations and audio, once available"""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        self.response["audio"] = b''.join(segment.result() for segment in self.segments)
+        return self.response
 
 class Chain:
-    def __init__(self, profiles: list[Profile], prompt: str):
+    def __init__(self, profiles: list[Profile], prompt: str, pipelined: bool = False, retrieval: str = 'llm', session: str = None):
+        if retrieval not in RETRIEVAL_MODES:
+            raise ValueError(f"retrieval must be one of {RETRIEVAL_MODES}, got '{retrieval}'")
         self.profiles = profiles
         self.prompt = prompt
+        self.pipelined = pipelined
+        self.retrieval = retrieval
+        #id of the streamlit session running the chain, for fair queueing in TURN_POOL
+        self.session = session
         self.index = 0
 
     def get_start(self):
@@ -220,4 +713,52 @@ class Chain:
         if self.index >= len(self.profiles):
             return None
         else:
-            return self.profiles[self.index]
\ No newline at end of file
+            return self.profiles[self.index]
+
+    def run(self, context: ConversationContext):
+        """yields a Turn for each profile in order. Each speaker sees context and the earlier
+        responses of this chain. A response is moved into context once the caller asks for the
+        next turn, which it does after showing it, so a chain stopped partway leaves only what was shown.
+        """
+        context = ChainContext(context)
+        turns = self.run_pipelined(context) if self.pipelined else self.run_sequential(context)
+        try:
+            for turn in turns:
+                yield turn
+                turn.done.wait()
+                if turn.error is None:
+                    context.commit()
+        finally:
+            turns.close()
+
+    def run_sequential(self, context: ChainContext):
+        """yields a Turn for each profile in order.
+        Each turn starts once the previous one has been consumed and its audio synthesized.
+        """
+        profile = self.get_start()
+        while profile:
+            turn = Turn(profile, self.retrieval, self.session)
+            aio.submit(turn.generate(context))
+            yield turn
+            turn.result()
+            profile = self.next_profile()
+
+    def run_pipelined(self, context: ChainContext):
+        """yields a Turn for each profile in order.
+        The next speaker only needs the previous speaker's text, so its text is generated
+        while the previous speaker's audio is still being synthesized and played.
+        """
+        turns = [ Turn(profile, self.retrieval, self.session) for profile in self.profiles ]
+
+        async def generate_turns():
+            for i, turn in enumerate(turns):
+                if not await turn.generate(context):
+                    for remaining in turns[i+1:]:
+                        remaining.fail(turn.error)
+                    return
+
+        task = aio.submit(generate_turns())
+        try:
+            yield from turns
+        finally:
+            task.cancel()
@@ -0,0 +1,58 @@
+# Description: Local SQLite store of chunk text and neighbours, keyed by chunk id
+import os
+import sqlite3
+from threading import Lock
+
+COLUMNS = ('politician', 'video_id', 'timestamp', 'title', 'created', 'prev', 'next', 'transcript')
+
+class ChunkStore:
+    """read-only store of chunk metadata written by setup/index.py.
+    Lets the vector index return ids only: text and prev/next neighbours are resolved locally.
+    """
+    STORE_FILE = 'chunks.sqlite'
+
+    def __init__(self, path: str):
+        self.path = path
+        uri = f"file:{os.path.join(path, self.STORE_FILE)}?mode=ro"
+        #one connection shared by the worker threads that run index calls
+        self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.lock = Lock()
+
+    def get(self, ids: list[str]) -> dict:
+        """returns metadatas keyed by id for ids and their prev/next neighbours, in one indexed lookup"""
+        ids = list(set(ids))
+        if len(ids) == 0:
+            return {}
+        placeholders = ','.join('?' * len(ids))
+        sql = f"""
+            SELECT id, {', '.join(COLUMNS)} FROM chunks WHERE id IN ({placeholders})
+            UNION
+            SELECT neighbour.id, {', '.join('neighbour.' + column for column in COLUMNS)}
+            FROM chunks AS center JOIN chunks AS neighbour ON neighbour.id IN (center.prev, center.next)
+            WHERE center.id IN ({placeholders})
+        """
+        with self.lock:
+            rows = self.connection.execute(sql, ids + ids).fetchall()
+        return { row[0]: dict(zip(COLUMNS, row[1:])) for row in rows }
+
+    @classmethod
+    def build(cls, path: str, chunks):
+        """writes a chunk store from an iterable of (chunk id, metadata with transcript) pairs,
+        which is consumed as it is written, so it can stream the corpus
+        """
+        os.makedirs(path, exist_ok=True)
+        store_path = os.path.join(path, cls.STORE_FILE)
+        tmp_path = store_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        connection = sqlite3.connect(tmp_path)
+        with connection:
+            connection.execute(f"CREATE TABLE chunks (id TEXT PRIMARY KEY, {', '.join(COLUMNS)}) WITHOUT ROWID")
+            connection.executemany(
+                f"INSERT OR REPLACE INTO chunks VALUES ({','.join('?' * (len(COLUMNS) + 1))})",
+                ( (id, *(md[column] for column in COLUMNS)) for id, md in chunks )
+            )
+        connection.close()
+        #swap in atomically so a running app never opens a half-written store
+        os.replace(tmp_path, store_path)
@@ -0,0 +1,198 @@
+# Description: Token-budgeted conversation history shared by the profiles in a session
+import openai
+from threading import Lock
+import aio
+from tracing import span
+from resilience import acall
+
+#Tokens of history sent to each model per request. Older turns are folded into a rolling summary,
+#so prompt size, latency and cost per turn stay flat however long the session runs.
+HISTORY_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo-16k-0613": 3000,
+    "gpt-4-0613": 2000,
+}
+DEFAULT_HISTORY_TOKEN_BUDGET = 2000
+
+SUMMARY_KEEP_TOKENS = 1000
+SUMMARY_MODEL = "gpt-3.5-turbo-16k-0613"
+SUMMARY_MAX_TOKENS = 300
+
+#Rough token count for English text; avoids shipping a tokenizer
+CHARS_PER_TOKEN = 4
+TOKENS_PER_MESSAGE = 4
+
+#Once the unsummarized history exceeds SUMMARY_TRIGGER_TOKENS, everything but the most recent
+#SUMMARY_KEEP_TOKENS is folded into the summary. The trigger is what the smallest budget leaves
+#next to a full summary, so no model's window drops a message before it is summarized.
+SUMMARY_TRIGGER_TOKENS = min(DEFAULT_HISTORY_TOKEN_BUDGET, *HISTORY_TOKEN_BUDGETS.values()) - SUMMARY_MAX_TOKENS - TOKENS_PER_MESSAGE
+
+def count_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + TOKENS_PER_MESSAGE
+
+class ConversationContext:
+    """append-only log of the conversation in openai format.
+    Messages are converted once when appended, and requests get the most recent messages that fit
+    the model's token budget, preceded by an incrementally maintained summary of the older ones.
+    A context built for a single request can pass summarize=False, since its summary would be thrown away.
+    """
+    def __init__(self, messages: list[dict] = None, summarize: bool = True):
+        self.summarize = summarize
+        self.messages = []
+        self.tokens = []
+        self.summary = ''
+        self.summary_tokens = 0
+        #messages before this index are covered by the summary
+        self.summarized = 0
+        self.unsummarized_tokens = 0
+        self.summarizing = False
+        self.lock = Lock()
+        for message in messages or []:
+            self.append(message)
+
+    @staticmethod
+    def format(message: dict) -> dict:
+        """converts a chat message (role is 'user', 'Molus' or a politician's name) to openai format,
+        or returns None for messages the politicians do not see
+        """
+        if message['role'] == 'Molus':
+            return None
+        if message['role'] == 'user':
+            return {'role': 'user', 'content': message['content']}
+        return {'role': 'assistant', 'content': f"{message['role']}: {message['content']}"}
+
+    def append(self, message: dict):
+        """appends a chat message (role is 'user', 'Molus' or a politician's name)"""
+        formatted = self.format(message)
+        if formatted is None:
+            return
+
+        with self.lock:
+            self.messages.append(formatted)
+            self.tokens.append(count_tokens(formatted['content']))
+            self.unsummarized_tokens += self.tokens[-1]
+            should_summarize = self.summarize and not self.summarizing and self.unsummarized_tokens > SUMMARY_TRIGGER_TOKENS
+            if should_summarize:
+                self.summarizing = True
+
+        if should_summarize:
+            aio.submit(self.asummarize())
+
+    def get_messages(self, model: str, reserved: int = 0) -> list[dict]:
+        """returns the summary and the most recent messages that fit the model's history budget,
+        less reserved tokens for messages that will follow them
+        """
+        budget = HISTORY_TOKEN_BUDGETS.get(model, DEFAULT_HISTORY_TOKEN_BUDGET) - reserved
+        with self.lock:
+            messages = []
+            if self.summary != '':
+                messages.append({'role': 'system', 'content': f"Summary of the earlier conversation:\n{self.summary}"})
+                budget -= self.summary_tokens
+
+            start = len(self.messages)
+            while start > self.summarized and (start == len(self.messages) or budget >= self.tokens[start-1]):
+                start -= 1
+                budget -= self.tokens[start]
+            return messages + self.messages[start:]
+
+    def get_recent(self, n: int) -> list[dict]:
+        with self.lock:
+            return self.messages[-n:]
+
+    def get_user_prompt(self) -> str:
+        """returns the latest user message"""
+        with self.lock:
+            for message in reversed(self.messages):
+                if message['role'] == 'user':
+                    return message['content']
+        return ''
+
+    async def asummarize(self):
+        """folds all but the most recent SUMMARY_KEEP_TOKENS of unsummarized history into the summary"""
+        try:
+            with self.lock:
+                end = len(self.messages)
+                kept = 0
+                while end > self.summarized and kept + self.tokens[end-1] <= SUMMARY_KEEP_TOKENS:
+                    end -= 1
+                    kept += self.tokens[end]
+                to_fold = self.messages[self.summarized:end]
+                summary = self.summary
+            if len(to_fold) == 0:
+                return
+
+            transcript = '\n'.join(f"{message['role']}: {message['content']}" for message in to_fold)
+            aio.get_session()
+            with span('summary', messages=len(to_fold)) as summary_span:
+                response = await acall(
+                    'openai', SUMMARY_MODEL, openai.ChatCompletion.acreate,
+                    tokens=count_tokens(transcript) + count_tokens(summary) + SUMMARY_MAX_TOKENS,
+                    model=SUMMARY_MODEL,
+                    max_tokens=SUMMARY_MAX_TOKENS,
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": "You maintain a running summary of a conversation between a user and several politicians. Update the summary with the new messages. Keep who said what, positions taken and open questions. Be concise."
+                        },
+                        {
+                            "role": "user",
+                            "content": f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"
+                        }
+                    ]
+                )
+                usage = response["usage"]
+                summary_span.meter(SUMMARY_MODEL, usage["prompt_tokens"], usage["completion_tokens"])
+            new_summary = response["choices"][0]["message"]["content"]
+
+            with self.lock:
+                self.summary = new_summary
+                self.summary_tokens = count_tokens(new_summary)
+                self.unsummarized_tokens -= sum(self.tokens[self.summarized:end])
+                self.summarized = end
+        finally:
+            with self.lock:
+                self.summarizing = False
+
+class ChainContext:
+    """a chain's view of the conversation: the session's context followed by the chain's turns
+    that have not been shown yet. A turn is moved into the session's context by commit once
+    it is shown, so a chain stopped partway leaves the shown turns and nothing else.
+    """
+    def __init__(self, context: ConversationContext):
+        self.context = context
+        #chat messages and their formatted version, oldest first
+        self.pending = []
+        self.messages = []
+        self.tokens = 0
+        self.lock = Lock()
+
+    def append(self, message: dict):
+        formatted = ConversationContext.format(message)
+        if formatted is None:
+            return
+        with self.lock:
+            self.pending.append(message)
+            self.messages.append(formatted)
+            self.tokens += count_tokens(formatted['content'])
+
+    def commit(self):
+        """moves the oldest pending turn into the session's context"""
+        with self.lock:
+            message = self.pending.pop(0)
+            formatted = self.messages.pop(0)
+            self.tokens -= count_tokens(formatted['content'])
+            self.context.append(message)
+
+    def get_messages(self, model: str) -> list[dict]:
+        with self.lock:
+            return self.context.get_messages(model, reserved=self.tokens) + self.messages
+
+    def get_recent(self, n: int) -> list[dict]:
+        with self.lock:
+            return (self.context.get_recent(n) + self.messages)[-n:]
+
+    def get_user_prompt(self) -> str:
+        with self.lock:
+            for message in reversed(self.messages):
+                if message['role'] == 'user':
+                    return message['content']
+            return self.context.get_user_prompt()
@@ -0,0 +1,120 @@
+# Description: BM25 inverted index over chunk transcripts, partitioned by politician
+import os
+import re
+import json
+import math
+from collections import Counter
+
+#BM25 term frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+#Queries with at most KEYWORD_MAX_TERMS content terms, all of them in the index, or with a quoted
+#phrase are keyword-heavy: BM25 alone ranks them well, so the embedding call can be skipped
+KEYWORD_MAX_TERMS = 3
+QUOTED_PHRASE = re.compile(r'"[^"]+"|“[^”]+”')
+
+TOKEN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself him himself
+his how i if in into is it its itself just me more most my myself no nor not now of off on once only or other our ours
+ourselves out over own same she should so some such than that the their theirs them themselves then there these they this
+those through to too under until up very was we were what when where which while who whom why will with would you your
+yours yourself yourselves think thoughts feel tell say said talk know let us going get
+""".split())
+
+def tokenize(text: str) -> list[str]:
+    """lowercases text and splits it into terms, dropping stopwords"""
+    return [ term for term in TOKEN.findall(text.lower()) if term not in STOPWORDS ]
+
+class BM25Partition:
+    """inverted index over one politician's chunks"""
+    def __init__(self, ids: list, lengths: list, postings: dict):
+        self.ids = ids
+        self.lengths = lengths
+        #term -> [[doc, term frequency], ...]
+        self.postings = postings
+        self.average_length = sum(lengths) / len(lengths) if len(lengths) > 0 else 0
+        self.idf = {
+            term: math.log(1 + (len(ids) - len(docs) + 0.5) / (len(docs) + 0.5)) for term, docs in postings.items()
+        }
+
+    def query(self, terms: list[str], top_k: int) -> list[tuple]:
+        """returns up to top_k (id, score) pairs ordered by descending score"""
+        scores = Counter()
+        for term in set(terms):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc, tf in self.postings[term]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc] / self.average_length)
+                scores[doc] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return [ (self.ids[doc], score) for doc, score in scores.most_common(top_k) ]
+
+    def coverage(self, terms: list[str]) -> float:
+        """fraction of the query terms that occur in this partition"""
+        if len(terms) == 0:
+            return 0
+        return sum(term in self.idf for term in terms) / len(terms)
+
+class LexicalIndex:
+    """BM25 search over chunk transcripts, loaded in-process.
+    Built by setup/index.py next to the vector index and queried with the same politician filter.
+    """
+    INDEX_FILE = 'lexical.json'
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, self.INDEX_FILE)) as f:
+            data = json.load(f)
+        self.partitions = {
+            politician: BM25Partition(partition['ids'], partition['lengths'], partition['postings'])
+            for politician, partition in data['partitions'].items()
+        }
+
+    def get_partition(self, politician: str) -> BM25Partition:
+        return self.partitions.get(politician)
+
+    def query(self, text: str, top_k: int, politician: str) -> list[tuple]:
+        """returns up to top_k (id, score) pairs for the politician's chunks"""
+        partition = self.get_partition(politician)
+        if partition is None:
+            return []
+        return partition.query(tokenize(text), top_k)
+
+    def is_keyword_query(self, text: str, politician: str) -> bool:
+        partition = self.get_partition(politician)
+        if partition is None:
+            return False
+        terms = tokenize(text)
+        if QUOTED_PHRASE.search(text) is not None:
+            return partition.coverage(terms) > 0
+        return 0 < len(terms) <= KEYWORD_MAX_TERMS and partition.coverage(terms) == 1
+
+    @classmethod
+    def build(cls, path: str, chunks):
+        """writes a lexical index from an iterable of (chunk id, searchable text, politician).
+        Only the postings are kept in memory, so chunks can stream the corpus
+        """
+        os.makedirs(path, exist_ok=True)
+        partitions = {}
+        for id, text, politician in chunks:
+            partition = partitions.setdefault(politician, {'ids': [], 'lengths': [], 'postings': {}})
+            doc = len(partition['ids'])
+            terms = tokenize(text)
+            partition['ids'].append(id)
+            partition['lengths'].append(len(terms))
+            for term, tf in Counter(terms).items():
+                partition['postings'].setdefault(term, []).append([doc, tf])
+
+        with open(os.path.join(path, cls.INDEX_FILE), 'w') as f:
+            json.dump({'partitions': partitions}, f)
+
+def fuse_rankings(rankings: list[list], top_k: int, k: int = 60) -> list:
+    """reciprocal rank fusion of several rankings of ids. returns the top_k ids"""
+    scores = Counter()
+    for ranking in rankings:
+        for rank, id in enumerate(ranking):
+            scores[id] += 1 / (k + rank + 1)
+    return [ id for id, _ in scores.most_common(top_k) ]
@@ -0,0 +1,108 @@
+# Description: Process-wide admission control and in-flight request coalescing on the shared event loop
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from tracing import get_current_span
+
+class OverloadedError(Exception):
+    pass
+
+class FairPool:
+    """lets at most max_active holders run at once across all sessions.
+    Waiters are served round robin by session, so one session's long chain cannot starve the others,
+    and requests beyond max_waiting (or max_waiting_per_session for one session) are refused at once
+    with OverloadedError instead of queueing without bound.
+    Must only be used from the shared loop.
+    """
+    def __init__(self, max_active: int, max_waiting: int, max_waiting_per_session: int):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.max_waiting_per_session = max_waiting_per_session
+        self.active = 0
+        self.waiting = 0
+        #session -> waiters in arrival order, sessions in serving order
+        self.queues = OrderedDict()
+
+    @asynccontextmanager
+    async def slot(self, session):
+        await self.acquire(session)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, session):
+        if self.active < self.max_active and self.waiting == 0:
+            self.active += 1
+            return
+
+        queue = self.queues.get(session, ())
+        if self.waiting >= self.max_waiting or len(queue) >= self.max_waiting_per_session:
+            raise OverloadedError(f'{self.active} requests running and {self.waiting} waiting')
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(session, deque()).append(waiter)
+        self.waiting += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                #the slot was handed over just before the cancellation
+                self.release()
+            else:
+                self.forget(session, waiter)
+            raise
+
+    def release(self):
+        """hands the slot to the first waiter of the next session in turn"""
+        while len(self.queues) > 0:
+            session, queue = next(iter(self.queues.items()))
+            waiter = queue.popleft()
+            self.waiting -= 1
+            if len(queue) > 0:
+                self.queues.move_to_end(session)
+            else:
+                del self.queues[session]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def forget(self, session, waiter):
+        queue = self.queues.get(session)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.waiting -= 1
+            if len(queue) == 0:
+                del self.queues[session]
+
+    def get_stats(self) -> dict:
+        return {'active': self.active, 'waiting': self.waiting, 'sessions_waiting': len(self.queues)}
+
+class Coalescer:
+    """runs at most one call per key at a time: concurrent calls with the same key share its result.
+    Must only be used from the shared loop.
+    """
+    def __init__(self):
+        self.inflight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def run(self, key, fn, *args, **kwargs):
+        """returns await fn(*args, **kwargs), joining the call already in flight for key if there is one"""
+        self.calls += 1
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self.inflight.pop(key) if self.inflight.get(key) is done else None)
+        else:
+            self.coalesced += 1
+            span = get_current_span()
+            if span is not None:
+                span.set(coalesced=True)
+        #shielded, so a caller that gives up does not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def get_stats(self) -> dict:
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'inflight': len(self.inflight)}
@@ -0,0 +1,242 @@
+# Description: Client-side rate limiting, retries and circuit breaking for outbound API calls
+import os
+import json
+import time
+import random
+import asyncio
+from threading import Lock
+from tracing import get_current_span
+
+#(requests per minute, tokens per minute) by (provider, model). 0 means unlimited.
+#Override with RATE_LIMITS='{"openai:gpt-4-0613": [500, 40000]}' to match the account's quota.
+RATE_LIMITS = {
+    ('openai', 'gpt-4-0613'): (500, 40000),
+    ('openai', 'gpt-3.5-turbo-16k-0613'): (3500, 180000),
+    ('openai', 'gpt-3.5-turbo-instruct'): (3500, 90000),
+    ('openai', 'text-embedding-ada-002'): (3000, 1000000),
+    ('elevenlabs', 'eleven_monolingual_v1'): (120, 0),
+    ('youtube', 'data-v3'): (600, 0),
+    ('youtube', 'transcripts'): (120, 0),
+    ('pinecone', 'v1'): (0, 0),
+}
+DEFAULT_RATE_LIMIT = (60, 0)
+for name, limit in json.loads(os.environ.get('RATE_LIMITS', '{}')).items():
+    RATE_LIMITS[tuple(name.split(':', 1))] = tuple(limit)
+
+#Buckets hold BURST_SECONDS worth of quota, so idle time buys a short burst but no more
+BURST_SECONDS = 10
+
+#Retries on 429, 5xx and connection errors, with full jitter: sleep uniformly in [0, min(MAX_DELAY, BASE_DELAY * 2^attempt)]
+MAX_RETRIES = 5
+BASE_DELAY = 0.5
+MAX_DELAY = 20
+
+#After BREAKER_THRESHOLD consecutive server or connection failures, calls fail fast for BREAKER_RESET seconds,
+#then a single trial call decides whether to close the breaker again. Rate limiting (429) never opens it.
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 30
+
+class CircuitOpenError(Exception):
+    def __init__(self, provider: str, model: str, retry_in: float):
+        super().__init__(f'{provider} {model} is failing, not calling it for another {retry_in:.0f}s')
+        self.retry_in = retry_in
+
+class TokenBucket:
+    """refills at rate per second up to capacity. Callers reserve what they need and wait until it is
+    available, so concurrent callers are served in order and never retry against an empty bucket.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def reserve(self, amount: float) -> float:
+        """takes amount from the bucket and returns how many seconds to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= amount
+            return max(0, -self.level / self.rate)
+
+    def pause(self, seconds: float):
+        """makes the next unit available in seconds at the earliest, e.g. when the provider says to back off"""
+        with self.lock:
+            self.level = min(self.level, 1 - seconds * self.rate)
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, reset: float):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = Lock()
+
+    def check(self, provider: str, model: str) -> bool:
+        """raises CircuitOpenError unless a call may go ahead. returns whether the call is the half-open trial"""
+        with self.lock:
+            if self.opened is None:
+                return False
+            elapsed = time.monotonic() - self.opened
+            if elapsed < self.reset or self.trial:
+                raise CircuitOpenError(provider, model, max(0, self.reset - elapsed))
+            #half open: let one trial call through
+            self.trial = True
+            return True
+
+    def succeed(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def abandon(self):
+        """the call gave no answer either way, e.g. it was cancelled: the next call may be the trial"""
+        with self.lock:
+            self.trial = False
+
+    def fail(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened is not None or self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+class Limiter:
+    """rate limits, retry policy and circuit breaker for one provider and model"""
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        rpm, tpm = RATE_LIMITS.get((provider, model), DEFAULT_RATE_LIMIT)
+        self.requests = TokenBucket(rpm / 60, rpm / 60 * BURST_SECONDS) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm / 60, tpm / 60 * BURST_SECONDS) if tpm > 0 else None
+        self.breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET)
+
+    def reserve(self, tokens: int) -> float:
+        wait = 0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None and tokens > 0:
+            wait = max(wait, self.tokens.reserve(tokens))
+        return wait
+
+    def get_delay(self, error: Exception, attempt: int) -> float:
+        """returns how long to wait before retrying after error, or None if it should not be retried"""
+        status = get_status(error)
+        failed = (status is not None and status >= 500) or (status is None and is_transient(error))
+        if failed:
+            self.breaker.fail()
+        else:
+            #the provider answered, so it is up, even if the request was rejected
+            self.breaker.succeed()
+        if not (failed or status == 429) or attempt >= MAX_RETRIES:
+            return None
+
+        delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+        if status == 429:
+            delay = max(delay, get_retry_after(error))
+            if self.requests is not None:
+                #hold back every caller of this model, not just this one. The wait then
+                #happens in reserve, in order with the other callers
+                self.requests.pause(delay)
+                delay = 0
+
+        span = get_current_span()
+        if span is not None:
+            span.add('retries', 1)
+        return delay
+
+_limiters = {}
+_lock = Lock()
+
+def get_limiter(provider: str, model: str) -> Limiter:
+    with _lock:
+        if (provider, model) not in _limiters:
+            _limiters[(provider, model)] = Limiter(provider, model)
+        return _limiters[(provider, model)]
+
+def call(provider: str, model: str, fn, /, *args, tokens: int = 0, **kwargs):
+    """calls fn(*args, **kwargs) within the provider's rate limits, retrying transient failures.
+    tokens is the estimated token usage of the request, for token-per-minute limits.
+    provider, model and fn are positional-only, so fn can itself take a model keyword.
+    """
+    limiter = get_limiter(provider, model)
+    attempt = 0
+    while True:
+        trial = limiter.breaker.check(provider, model)
+        try:
+            wait = limiter.reserve(tokens)
+            if wait > 0:
+                time.sleep(wait)
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            delay = limiter.get_delay(e, attempt)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        except BaseException:
+            #cancelled or interrupted, which says nothing about the provider. If this was
+            #the half-open trial, the next call takes its place instead of failing forever
+            if trial:
+                limiter.breaker.abandon()
+            raise
+        limiter.breaker.succeed()
+        return result
+
+async def acall(provider: str, model: str, fn, /, *args, tokens: int = 0, **kwargs):
+    """async version of call, for an fn that returns an awaitable"""
+    limiter = get_limiter(provider, model)
+    attempt = 0
+    while True:
+        trial = limiter.breaker.check(provider, model)
+        try:
+            wait = limiter.reserve(tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            delay = limiter.get_delay(e, attempt)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        except BaseException:
+            #cancelled or interrupted, which says nothing about the provider. If this was
+            #the half-open trial, the next call takes its place instead of failing forever
+            if trial:
+                limiter.breaker.abandon()
+            raise
+        limiter.breaker.succeed()
+        return result
+
+def get_status(error: Exception) -> int:
+    """returns the HTTP status of an openai, aiohttp or google api error, or None"""
+    for attr in ('http_status', 'status', 'status_code'):
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status
+    response = getattr(error, 'resp', None)
+    status = getattr(response, 'status', None)
+    return int(status) if status is not None else None
+
+def get_retry_after(error: Exception) -> float:
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after') or headers.get('Retry-After') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def is_transient(error: Exception) -> bool:
+    """connection failures and timeouts, which carry no status"""
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    #openai.error.Timeout, APIConnectionError, TryAgain and aiohttp.ClientConnectionError, matched by name
+    #so this module does not import either client
+    names = { cls.__name__ for cls in type(error).__mro__ }
+    return len(names & {'Timeout', 'APIConnectionError', 'TryAgain', 'ServiceUnavailableError', 'ClientConnectionError'}) > 0
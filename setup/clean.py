@@ -6,6 +6,11 @@ from googleapiclient.discovery import build
 from dotenv import load_dotenv
 from tqdm import tqdm
 import os
+import sys
+
+#make the app modules importable when run as `python setup/clean.py`
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from resilience import call
 
 load_dotenv()
 YOUTUBE = build('youtube', 'v3', developerKey=os.getenv('YOUTUBE_API_KEY'))
@@ -43,10 +48,11 @@ def load_crawls():
 
 def fetch_video_details(video_ids):
     # Make an API call to the YouTube API to fetch information about the video
-    response = YOUTUBE.videos().list(
+    request = YOUTUBE.videos().list(
         part="snippet,contentDetails",
         id=video_ids
-    ).execute()
+    )
+    response = call('youtube', 'data-v3', request.execute)
 
    #Extract duration and description from response
     descriptions = []
@@ -136,11 +142,13 @@ def evaluate(row):
     Channel Title: {channelTitle}"""
 
     # create openAI endpoint
-    result = openai.Completion.create(
+    result = call(
+        'openai', 'gpt-3.5-turbo-instruct', openai.Completion.create,
         model="gpt-3.5-turbo-instruct",
         prompt=content_filter_prompt,
         max_tokens=1000,
-        n=3
+        n=3,
+        tokens=len(content_filter_prompt) // 4 + 1000 * 3
     )
 
     choices = result['choices']
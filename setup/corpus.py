@@ -0,0 +1,123 @@
+# Description: The chunked transcript corpus as a Parquet dataset partitioned by politician, one row per chunk
+#
+# usage: python setup/corpus.py    converts setup/embeds.pkl to setup/corpus
+import os
+import sys
+import shutil
+import pickle
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+#one row per chunk. embedding is optional and null unless the writer was given embeddings
+SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('politician', pa.string()),
+    ('video_id', pa.string()),
+    ('title', pa.string()),
+    ('created', pa.string()),
+    ('timestamp', pa.int64()),
+    ('prev', pa.string()),
+    ('next', pa.string()),
+    ('transcript', pa.string()),
+    ('embedding', pa.list_(pa.float32())),
+])
+#the columns needed to index a chunk, which is everything but its embedding
+CHUNK_COLUMNS = [ name for name in SCHEMA.names if name != 'embedding' ]
+PARTITIONING = ds.partitioning(pa.schema([('politician', pa.string())]), flavor='hive')
+
+#videos are converted and written WRITE_BATCH_VIDEOS at a time, and read back READ_BATCH_ROWS rows at a time
+WRITE_BATCH_VIDEOS = 50
+READ_BATCH_ROWS = 4096
+
+def get_rows(video, embeddings: list = None) -> dict:
+    """returns the chunks of a node.YTVideo as columns"""
+    metadatas = video.get_chunk_metadatas()
+    return {
+        'id': video.get_chunk_ids(),
+        'politician': [ md['politician'] for md in metadatas ],
+        'video_id': [ md['video_id'] for md in metadatas ],
+        'title': [ md['title'] for md in metadatas ],
+        'created': [ md['created'] for md in metadatas ],
+        'timestamp': [ int(md['timestamp']) for md in metadatas ],
+        'prev': [ md['prev'] for md in metadatas ],
+        'next': [ md['next'] for md in metadatas ],
+        'transcript': video.get_chunk_transcripts(),
+        'embedding': embeddings if embeddings is not None else [None] * len(metadatas),
+    }
+
+def to_batches(videos):
+    """converts an iterable of node.YTVideo, or of (YTVideo, chunk embeddings) pairs, to record batches"""
+    columns = { name: [] for name in SCHEMA.names }
+    count = 0
+    for video in videos:
+        video, embeddings = video if isinstance(video, tuple) else (video, None)
+        for name, values in get_rows(video, embeddings).items():
+            columns[name].extend(values)
+        count += 1
+        if count % WRITE_BATCH_VIDEOS == 0:
+            yield pa.RecordBatch.from_pydict(columns, schema=SCHEMA)
+            columns = { name: [] for name in SCHEMA.names }
+    if len(columns['id']) > 0:
+        yield pa.RecordBatch.from_pydict(columns, schema=SCHEMA)
+
+def write(path: str, videos):
+    """writes the corpus from an iterable of node.YTVideo, streaming it so only a few videos are held at once.
+    The previous corpus at path is replaced once the new one is complete.
+    """
+    tmp_path = path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    ds.write_dataset(
+        to_batches(videos),
+        tmp_path,
+        schema=SCHEMA,
+        format='parquet',
+        partitioning=PARTITIONING,
+        basename_template='part-{i}.parquet'
+    )
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+def open_dataset(path: str) -> ds.Dataset:
+    return ds.dataset(path, schema=SCHEMA, format='parquet', partitioning=PARTITIONING)
+
+def read_batches(path: str, columns: list[str] = None, politician: str = None):
+    """yields the corpus as record batches of up to READ_BATCH_ROWS rows, reading only the given columns
+    and, if politician is given, only that politician's partition
+    """
+    dataset = open_dataset(path)
+    filter = ds.field('politician') == politician if politician is not None else None
+    yield from dataset.to_batches(columns=columns, filter=filter, batch_size=READ_BATCH_ROWS)
+
+def read_chunks(path: str, columns: list[str] = CHUNK_COLUMNS):
+    """yields (id, metadata) for every chunk, where metadata holds the other columns"""
+    for batch in read_batches(path, columns=columns):
+        for row in batch.to_pylist():
+            yield row.pop('id'), row
+
+def read_table(path: str, columns: list[str] = None) -> pa.Table:
+    """reads the given columns of the whole corpus, memory-mapping the files"""
+    return pq.read_table(path, columns=columns, schema=SCHEMA, partitioning=PARTITIONING, memory_map=True)
+
+def count_rows(path: str) -> int:
+    """counts the chunks from the file footers, without reading any data"""
+    return open_dataset(path).count_rows()
+
+if __name__ == '__main__':
+
+    #make node importable for unpickling when run from the repo root
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+    cwd = os.getcwd()
+    pickle_path = os.path.join(cwd, 'setup/embeds.pkl')
+    corpus_path = os.path.join(cwd, 'setup/corpus')
+
+    print('Reading in YTVideo objects...')
+    with open(pickle_path, 'rb') as f:
+        ytvids = pickle.load(f)
+
+    print('Writing corpus...')
+    write(corpus_path, ytvids)
+    print(f'Wrote {count_rows(corpus_path)} chunks of {len(ytvids)} videos to', corpus_path)
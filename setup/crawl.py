@@ -4,10 +4,16 @@ import os
 import json
 import datetime
 import csv
+import sys
 from tqdm import tqdm
 from dotenv import load_dotenv
 from googleapiclient.discovery import build
 
+#make the app modules importable when run as `python setup/crawl.py`
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import get_embedding, EMBEDDING_CACHE
+from resilience import call
+
 # Load API keys
 load_dotenv()
 openai.api_key = os.environ['OPENAI_API_KEY']
@@ -126,11 +132,13 @@ class YouTubeCrawler:
         """
 
         # create openAI endpoint
-        result = openai.Completion.create(
+        result = call(
+            'openai', 'gpt-3.5-turbo-instruct', openai.Completion.create,
             model="gpt-3.5-turbo-instruct",
             prompt=content_filter_prompt,
             max_tokens=1000,
-            n=k
+            n=k,
+            tokens=len(content_filter_prompt) // 4 + 1000 * k
         )
 
         choices = result['choices']
@@ -167,7 +175,7 @@ class YouTubeCrawler:
                 videoDuration=self.length,
                 videoCaption='closedCaption'
             )
-            response = request.execute()
+            response = call('youtube', 'data-v3', request.execute)
 
         except Exception as e:
             print("Error executing request:")
@@ -334,10 +342,12 @@ class Database:
         """
 
         # create openAI endpoint
-        results = openai.Completion.create(
+        results = call(
+            'openai', 'gpt-3.5-turbo-instruct', openai.Completion.create,
             model="gpt-3.5-turbo-instruct",
             prompt=similarity_filter_prompt,
-            max_tokens=500
+            max_tokens=500,
+            tokens=len(similarity_filter_prompt) // 4 + 500
         )
 
         response = results['choices'][0]['text']
@@ -353,8 +363,7 @@ class Database:
 
 
     def get_embedding(self, text, model="text-embedding-ada-002"):
-        text = text.replace("\n", " ")
-        return openai.Embedding.create(input = [text], model=model)['data'][0]['embedding']
+        return get_embedding(text, model=model)
 
     def add(self, result: dict):
 
@@ -435,6 +444,8 @@ if __name__ == '__main__':
 
     crawl.save()
 
+    print('Embedding cache:', EMBEDDING_CACHE.get_stats())
+
     # #For testing
     # crawl.run(
     #     politician="Joe Biden",
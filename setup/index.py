@@ -4,26 +4,61 @@ import sys
 import random
 import openai
 import pinecone
-import pickle
-from youtube_transcript_api import YouTubeTranscriptApi
+from concurrent.futures import ThreadPoolExecutor
 from googleapiclient.discovery import build
 from dotenv import load_dotenv
 from tqdm import tqdm
 from node import YTVideo, YTVideoChunk, NULL_ID, is_null, hash_string
+import corpus
+
+#make the app modules importable when run as `python setup/index.py`
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vectorstore import LocalIndex
+from lexical import LexicalIndex
+from chunkstore import ChunkStore
+from manifest import ChunkManifest
+from utils import get_embeddings, EMBEDDING_CACHE
+from resilience import call
+
+#chunks are embedded in groups of about EMBED_GROUP_SIZE across videos, so the embeddings
+#of the whole corpus are not held in memory unless a local index is built
+EMBED_GROUP_SIZE = 4096
+#pinecone recommends upserts of at most 100 vectors; UPSERT_WORKERS batches are sent at once
+UPSERT_BATCH_SIZE = 100
+UPSERT_WORKERS = 4
+#pinecone deletes at most 1000 ids per request
+DELETE_BATCH_SIZE = 1000
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+#changing the template re-embeds every chunk on the next run, see ChunkManifest
+EMBEDDING_TEMPLATE = """This is a transcript of a video of {politician} speaking.
+        The video was created on {created}.
+        The title of the video is {title}.
+        The transcript is as follows:
+        "{text}"
+        """
+
+def get_embedding_text(politician: str, created: str, title: str, text: str) -> str:
+    return EMBEDDING_TEMPLATE.format(politician=politician, created=created, title=title, text=text)
 
-def get_embedding(text, model="text-embedding-ada-002"):
-   text = text.replace("\n", " ")
-   return openai.Embedding.create(input = [text], model=model)['data'][0]['embedding']
+def upsert(index, index_name: str, vectors: list[tuple]):
+    """upserts (id, embedding, metadata) vectors in batches of UPSERT_BATCH_SIZE"""
+    batches = [ vectors[i:i+UPSERT_BATCH_SIZE] for i in range(0, len(vectors), UPSERT_BATCH_SIZE) ]
+    with ThreadPoolExecutor(UPSERT_WORKERS) as executor:
+        for _ in executor.map(lambda batch: call('pinecone', index_name, index.upsert, vectors=batch), batches):
+            pass
 
 if __name__ == '__main__':
 
     #get delete flag from stdin
     print('Getting delete flag...')
-    delete_flag = False
-    if len(sys.argv) > 1:
-        delete_flag = sys.argv[1] == 'delete'
+    delete_flag = 'delete' in sys.argv[1:]
     print('Delete flag:', delete_flag)
 
+    #get local flag from stdin: write a local memory-mapped index instead of upserting to pinecone
+    local_flag = 'local' in sys.argv[1:]
+    print('Local flag:', local_flag)
+
     print('Starting index.py...')
 
     #load env vars
@@ -36,26 +71,29 @@ if __name__ == '__main__':
     print('Loaded env vars...')
 
     #connect to pinecone
-    print('Connecting to Pinecone...')
-    print('pinecone_api_key:', pinecone_api_key)
-    print('pinecone_env:', pinecone_env)
-    pinecone.init(api_key=pinecone_api_key, environment=pinecone_env)
-    print('Pinecone indexes:', pinecone.list_indexes())
-    index_name = 'v1'
-    dimensions = 1536
-
-    #delete index if delete flag is set
-    if delete_flag and index_name in pinecone.list_indexes():
-        pinecone.delete_index(index_name)
-        print('Deleted index...')
-
-    if index_name not in pinecone.list_indexes():
-        pinecone.create_index(name=index_name, dimension=dimensions, metric='cosine')
-        print('Created index...')
-
-    index = pinecone.Index(index_name=index_name)
-    print('Connected to Pinecone...')
-    
+    if not local_flag:
+        print('Connecting to Pinecone...')
+        print('pinecone_api_key:', pinecone_api_key)
+        print('pinecone_env:', pinecone_env)
+        pinecone.init(api_key=pinecone_api_key, environment=pinecone_env)
+        print('Pinecone indexes:', pinecone.list_indexes())
+        index_name = 'v1'
+        dimensions = 1536
+
+        #delete index if delete flag is set
+        if delete_flag and index_name in pinecone.list_indexes():
+            pinecone.delete_index(index_name)
+            print('Deleted index...')
+
+        #deleted or never created, e.g. in a new project
+        created = index_name not in pinecone.list_indexes()
+        if created:
+            pinecone.create_index(name=index_name, dimension=dimensions, metric='cosine')
+            print('Created index...')
+
+        index = pinecone.Index(index_name=index_name)
+        print('Connected to Pinecone...')
+
     # #read in csv
     # print('Reading in csv...')
     # cwd = os.getcwd()
@@ -73,17 +111,14 @@ if __name__ == '__main__':
     # listvideo_ids = [ str(video_id) for video_id in listvideo_ids ]
     # # listvideo_ids = listvideo_ids[:10]
 
-    # #get transcript for each video_id
+    # #get transcript for each video_id, fetching only those not in the transcript cache
     # print('Getting transcripts...')
-    # result = YouTubeTranscriptApi.get_transcripts(
-    #     video_ids=listvideo_ids,
-    #     languages=['en', 'en-US'],
-    #     continue_after_error=True
-    # )
+    # from transcripts import TranscriptCache
+    # result = TranscriptCache(os.path.join(cwd, 'setup/transcripts')).fetch(listvideo_ids)
 
     # # extract data from result
     # print('Extracting data...')
-    # items = [ (video_id, transcript) for video_id, transcript in result[0].items() ]
+    # items = [ (video_id, transcript) for video_id, transcript in result.items() ]
     # video_ids, transcripts = zip(*items)
 
     # politician_names = [ politicians_by_video_id[video_id] for video_id in video_ids ]
@@ -121,47 +156,100 @@ if __name__ == '__main__':
     #     )
     #     ytvids.append(ytvid)
 
-    # #store YTVideo objects as pickle
+    # #store YTVideo objects in the corpus
     # print('Storing YTVideo objects...')
-    # path = os.path.join(cwd, 'setup/embeds.pkl')
-    # with open(path, 'wb') as f:
-    #     pickle.dump(ytvids, f)
+    # corpus.write(os.path.join(cwd, 'setup/corpus'), ytvids)
     
-    # OPTIONAL LINE: read in YTVideo objects from pickle
-    print('Reading in YTVideo objects...')
+    #the corpus is streamed in record batches, see setup/corpus.py to convert an embeds.pkl
     cwd = os.getcwd()
-    path = os.path.join(cwd, 'setup/embeds.pkl')
-    with open(path, 'rb') as f:
-        ytvids = pickle.load(f)
-
-    #upsert data for each video
+    corpus_path = os.path.join(cwd, 'setup/corpus')
+    print('Chunks in corpus:', corpus.count_rows(corpus_path))
+
+    #what is already in the pinecone index. The local index is rebuilt in full on every run,
+    #with unchanged chunks' embeddings read from the embedding cache
+    manifest = ChunkManifest(os.path.join(cwd, 'setup/index_manifest.json'))
+    if local_flag:
+        #every chunk goes into the local index
+        manifest.clear()
+    elif created:
+        #the index is empty, whatever the manifest says
+        manifest.clear()
+        manifest.save()
+    skipped = 0
+
+    #local index rows, written once all videos are embedded
+    local_ids, local_embeds, local_metadatas = [], [], []
+    #ids in the corpus, to find the chunks that vanished from it
+    corpus_ids = set()
+    #chunks waiting to be embedded
+    pending_ids, pending_texts, pending_metadatas, pending_entries = [], [], [], {}
+    progress = tqdm(desc='Embedding', unit='chunk')
+
+    def flush():
+        """embeds the pending chunks, then upserts them and checkpoints the manifest, or keeps them for the local index"""
+        embeds = get_embeddings(pending_texts, model=EMBEDDING_MODEL, on_batch=progress.update)
+        if local_flag:
+            local_ids.extend(pending_ids)
+            local_embeds.extend(embeds)
+            local_metadatas.extend(pending_metadatas)
+        else:
+            upsert(index, index_name, list(zip(pending_ids, embeds, pending_metadatas)))
+            manifest.update(pending_entries)
+            manifest.save()
+        pending_ids.clear()
+        pending_texts.clear()
+        pending_metadatas.clear()
+        pending_entries.clear()
+
+    #embed and upsert data for each video
     print('Upserting data...')
-    for vid in tqdm(ytvids):
-        texts = vid.get_chunk_transcripts()
-        metadatas = vid.get_chunk_metadatas()
-        ids = vid.get_chunk_ids()
-
-        politician = vid.politican
-        title = vid.title
-        created = vid.created
-
-        embedding_texts = [ 
-        f"""This is a transcript of a video of {politician} speaking.
-        The video was created on {created}.
-        The title of the video is {title}.
-        The transcript is as follows:
-        "{text}"
-        """
-        for text in texts
-        ]
-
-        embeds = [ get_embedding(text) for text in embedding_texts ]
-
-        for i, md in enumerate(metadatas):
-            md['transcript'] = texts[i]
-
-        to_upsert = zip(ids, embeds, metadatas)
-
-        upsert_response = index.upsert(
-            vectors=to_upsert
-        )
+    for id, md in corpus.read_chunks(corpus_path):
+        corpus_ids.add(id)
+
+        #only new or changed chunks are embedded and upserted
+        entry = ChunkManifest.get_entry(md['transcript'], EMBEDDING_TEMPLATE, EMBEDDING_MODEL, md)
+        if manifest.is_current(id, entry):
+            skipped += 1
+            continue
+        pending_ids.append(id)
+        pending_texts.append(get_embedding_text(md['politician'], md['created'], md['title'], md['transcript']))
+        pending_metadatas.append(md)
+        pending_entries[id] = entry
+        if len(pending_ids) >= EMBED_GROUP_SIZE:
+            flush()
+
+    flush()
+    progress.close()
+    print('Skipped unchanged chunks:', skipped)
+
+    #chunks no longer in the corpus
+    if not local_flag:
+        vanished = manifest.get_vanished(corpus_ids)
+        print('Deleting vanished chunks:', len(vanished))
+        for i in range(0, len(vanished), DELETE_BATCH_SIZE):
+            batch = vanished[i:i+DELETE_BATCH_SIZE]
+            call('pinecone', index_name, index.delete, ids=batch)
+            manifest.remove(batch)
+            manifest.save()
+    print('Embedding cache:', EMBEDDING_CACHE.get_stats())
+
+    if local_flag:
+        print('Writing local index...')
+        path = os.path.join(cwd, 'setup/local_index')
+        LocalIndex.build(path, local_ids, local_embeds, local_metadatas)
+        print('Wrote local index to', path)
+
+    #the lexical index and chunk store are always written, since both are read in-process next to
+    #either vector backend. Each streams the corpus again rather than holding it in memory
+    print('Writing lexical index...')
+    path = os.path.join(cwd, 'setup/lexical_index')
+    LexicalIndex.build(path, (
+        (id, f"{md['title']}\n{md['transcript']}", md['politician'])
+        for id, md in corpus.read_chunks(corpus_path, columns=['id', 'politician', 'title', 'transcript'])
+    ))
+    print('Wrote lexical index to', path)
+
+    print('Writing chunk store...')
+    path = os.path.join(cwd, 'setup/chunk_store')
+    ChunkStore.build(path, corpus.read_chunks(corpus_path))
+    print('Wrote chunk store to', path)
@@ -0,0 +1,48 @@
+# Description: Record of the chunks in the vector index, so re-runs of index.py only embed and upsert what changed
+import os
+import json
+from node import hash_string
+
+class ChunkManifest:
+    """for each indexed chunk id, hashes of its transcript, embedding template and metadata, and its embedding model.
+    Saved atomically at each checkpoint, so an interrupted run resumes after the last one.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.chunks = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.chunks = json.load(f)['chunks']
+
+    @staticmethod
+    def get_entry(transcript: str, template: str, model: str, metadata: dict) -> dict:
+        return {
+            'transcript': hash_string(transcript),
+            'template': hash_string(template),
+            'model': model,
+            'metadata': hash_string(json.dumps(metadata, sort_keys=True))
+        }
+
+    def is_current(self, id: str, entry: dict) -> bool:
+        """whether the chunk is indexed exactly as described by entry"""
+        return self.chunks.get(id) == entry
+
+    def get_vanished(self, ids: set) -> list[str]:
+        """returns the indexed chunk ids that are not in ids"""
+        return [ id for id in self.chunks if id not in ids ]
+
+    def update(self, entries: dict):
+        self.chunks.update(entries)
+
+    def remove(self, ids: list[str]):
+        for id in ids:
+            self.chunks.pop(id, None)
+
+    def clear(self):
+        self.chunks = {}
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'chunks': self.chunks}, f)
+        os.replace(tmp_path, self.path)
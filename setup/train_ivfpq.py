@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import numpy as np
+
+#make the app modules importable when run as `python setup/train_ivfpq.py`
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vectorstore import LocalIndex, IVFPQIndex
+
+#queries used to measure recall: indexed embeddings with gaussian noise, so a query is near but not on a chunk
+RECALL_QUERIES = 200
+RECALL_K = 5
+QUERY_NOISE = 0.02
+
+if __name__ == '__main__':
+
+    #trains on the local index written by `python setup/index.py local`
+    cwd = os.getcwd()
+    path = os.path.join(cwd, 'setup/local_index')
+
+    print('Training IVF-PQ index...')
+    start = time.perf_counter()
+    IVFPQIndex.train(path)
+    print(f'Trained in {time.perf_counter() - start:.1f}s')
+
+    exact = LocalIndex(path)
+    compressed = IVFPQIndex(path, metadata=False)
+    #what each worker holds: the embeddings and metadata for exact search, against the compressed
+    #index with ids only (chunk store) or with the metadata (no chunk store)
+    full_bytes = exact.embeddings.nbytes + exact.metadata_bytes
+    resident_bytes = compressed.get_resident_bytes()
+    with_metadata_bytes = resident_bytes - compressed.metadata_bytes + exact.metadata_bytes
+    print(f'Embeddings and metadata: {full_bytes / 1e6:.1f} MB')
+    print(f'Compressed index with chunk store: {resident_bytes / 1e6:.1f} MB ({full_bytes / resident_bytes:.1f}x smaller)')
+    print(f'Compressed index with metadata: {with_metadata_bytes / 1e6:.1f} MB ({full_bytes / with_metadata_bytes:.1f}x smaller)')
+
+    #recall@K of the compressed index against exact search, per politician
+    print('Measuring recall...')
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(exact.ids), size=min(RECALL_QUERIES, len(exact.ids)), replace=False)
+    hits, relevant, exact_time, compressed_time = 0, 0, 0, 0
+    for row in rows:
+        politician = exact.metadatas[row]['politician']
+        xq = exact.embeddings[row] + rng.normal(scale=QUERY_NOISE, size=exact.embeddings.shape[1])
+        query_filter = {'politician': politician}
+
+        start = time.perf_counter()
+        expected = exact.query(xq, top_k=RECALL_K, include_metadata=False, filter=query_filter)['matches']
+        exact_time += time.perf_counter() - start
+        start = time.perf_counter()
+        found = compressed.query(xq, top_k=RECALL_K, include_metadata=False, filter=query_filter)['matches']
+        compressed_time += time.perf_counter() - start
+
+        hits += len({ m['id'] for m in expected } & { m['id'] for m in found })
+        relevant += len(expected)
+
+    recall = hits / relevant
+    print(f'Recall@{RECALL_K}: {recall:.3f} (nprobe={compressed.IVF_NPROBE})')
+    print(f'Query time: exact {exact_time / len(rows) * 1000:.2f} ms, compressed {compressed_time / len(rows) * 1000:.2f} ms')
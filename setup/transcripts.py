@@ -0,0 +1,113 @@
+# Description: Fetches video transcripts with a pool of workers into an on-disk cache, one file per video id
+#
+# usage: python setup/transcripts.py    fetches the transcripts of setup/videoids.csv that are not cached yet
+import os
+import sys
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from youtube_transcript_api import YouTubeTranscriptApi
+from youtube_transcript_api import TranscriptsDisabled, NoTranscriptFound, NoTranscriptAvailable, VideoUnavailable, InvalidVideoId
+from tqdm import tqdm
+
+#make the app modules importable when run as `python setup/transcripts.py`
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from resilience import call
+
+LANGUAGES = ['en', 'en-US']
+TRANSCRIPT_WORKERS = int(os.environ.get('TRANSCRIPT_WORKERS', 8))
+#errors that will not go away on retry, recorded so the video is not fetched again.
+#Anything else (rate limiting, network failures) is left for the next run.
+PERMANENT_ERRORS = (TranscriptsDisabled, NoTranscriptFound, NoTranscriptAvailable, VideoUnavailable, InvalidVideoId)
+
+class TranscriptCache:
+    """raw youtube_transcript_api transcripts stored as <video id>.json, and the videos
+    that have no transcript to fetch in failures.json
+    """
+    FAILURES_FILE = 'failures.json'
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.failures = {}
+        failures_path = os.path.join(path, self.FAILURES_FILE)
+        if os.path.exists(failures_path):
+            with open(failures_path) as f:
+                self.failures = json.load(f)
+
+    def get_path(self, video_id: str) -> str:
+        return os.path.join(self.path, f'{video_id}.json')
+
+    def has(self, video_id: str) -> bool:
+        return os.path.exists(self.get_path(video_id))
+
+    def get(self, video_id: str) -> list[dict]:
+        """returns the cached transcript, or None"""
+        if not self.has(video_id):
+            return None
+        with open(self.get_path(video_id)) as f:
+            return json.load(f)
+
+    def put(self, video_id: str, transcript: list[dict]):
+        write_json(self.get_path(video_id), transcript)
+
+    def fail(self, video_id: str, error: Exception):
+        self.failures[video_id] = type(error).__name__
+        write_json(os.path.join(self.path, self.FAILURES_FILE), self.failures)
+
+    def get_missing(self, video_ids: list[str]) -> list[str]:
+        """returns the video ids that are neither cached nor known to have no transcript"""
+        return [ video_id for video_id in dict.fromkeys(video_ids) if video_id not in self.failures and not self.has(video_id) ]
+
+    def fetch(self, video_ids: list[str]) -> dict:
+        """fetches the missing transcripts of video_ids with TRANSCRIPT_WORKERS workers.
+        returns the transcripts of all of video_ids that are available, keyed by video id
+        """
+        missing = self.get_missing(video_ids)
+        print(f'Fetching {len(missing)} of {len(video_ids)} transcripts...')
+
+        errors = {}
+        with ThreadPoolExecutor(TRANSCRIPT_WORKERS) as executor:
+            futures = {
+                executor.submit(call, 'youtube', 'transcripts', YouTubeTranscriptApi.get_transcript, video_id, languages=LANGUAGES): video_id
+                for video_id in missing
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                video_id = futures[future]
+                try:
+                    self.put(video_id, future.result())
+                except PERMANENT_ERRORS as e:
+                    self.fail(video_id, e)
+                except Exception as e:
+                    errors[video_id] = e
+        if len(errors) > 0:
+            print(f'Failed to fetch {len(errors)} transcripts, they will be retried on the next run:', {
+                video_id: type(error).__name__ for video_id, error in errors.items()
+            })
+
+        transcripts = {}
+        for video_id in video_ids:
+            transcript = self.get(video_id)
+            if transcript is not None:
+                transcripts[video_id] = transcript
+        return transcripts
+
+def write_json(path: str, data):
+    #write to a temporary file and rename, so an interrupted run never leaves a partial entry
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+if __name__ == '__main__':
+
+    cwd = os.getcwd()
+    with open(os.path.join(cwd, 'setup/videoids.csv')) as f:
+        reader = csv.reader(f)
+        #skip header
+        next(reader)
+        video_ids = [ str(video_id) for _, video_id in reader ]
+
+    cache = TranscriptCache(os.path.join(cwd, 'setup/transcripts'))
+    transcripts = cache.fetch(video_ids)
+    print(f'{len(transcripts)} transcripts cached, {len(cache.failures)} videos without a transcript')
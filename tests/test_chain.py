@@ -0,0 +1,65 @@
+import os
+import sys
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('openai')
+pytest.importorskip('elevenlabs')
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import chain
+from chain import Chain, Profile, RESPONSE_MODEL
+from context import ConversationContext
+
+@pytest.fixture
+def histories(monkeypatch):
+    """replaces the model calls of Profile, recording the history each response was generated from"""
+    histories = []
+
+    async def aget_cached_response(self, context):
+        return (None, None), None
+
+    async def acache_response(self, cache_key, response, segments):
+        pass
+
+    async def aprepare_response(self, context, retrieval='llm'):
+        return 'question', 'quotes', []
+
+    async def astream_response(self, context, question, kb_response, all_citations, on_token=None):
+        histories.append([ message['content'] for message in context.get_messages(RESPONSE_MODEL) ])
+        return {'role': self.name, 'content': f'turn {len(histories)}', 'citations': []}
+
+    monkeypatch.setattr(Profile, 'aget_cached_response', aget_cached_response)
+    monkeypatch.setattr(Profile, 'acache_response', acache_response)
+    monkeypatch.setattr(Profile, 'aprepare_response', aprepare_response)
+    monkeypatch.setattr(Profile, 'astream_response', astream_response)
+    return histories
+
+def run_like_app(chain: Chain, context: ConversationContext, messages: list, fail_at: int = None):
+    """consumes the chain the way app.run_and_display_chain does"""
+    for i, turn in enumerate(chain.run(context)):
+        response = turn.result()
+        if i == fail_at:
+            raise RuntimeError('display failed')
+        messages.append(response)
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_each_turn_reaches_the_model_once(histories, pipelined):
+    profiles = [ Profile(None, shortcode) for shortcode in ['dt', 'jb', 'dt', 'jb', 'dt'] ]
+    context = ConversationContext([{'role': 'user', 'content': 'hi'}])
+    messages = []
+    run_like_app(Chain(profiles, 'hi', pipelined=pipelined), context, messages)
+
+    said = [ f"{profile.name}: turn {i+1}" for i, profile in enumerate(profiles) ]
+    assert histories == [ ['hi'] + said[:i] for i in range(len(profiles)) ]
+    assert [ message['content'] for message in context.messages ] == ['hi'] + said
+    assert len(messages) == len(profiles)
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_stopped_chain_keeps_only_the_shown_turns(histories, pipelined):
+    profiles = [ Profile(None, shortcode) for shortcode in ['dt', 'jb', 'dt'] ]
+    context = ConversationContext([{'role': 'user', 'content': 'hi'}])
+    with pytest.raises(RuntimeError):
+        run_like_app(Chain(profiles, 'hi', pipelined=pipelined), context, [], fail_at=1)
+
+    assert [ message['content'] for message in context.messages ] == ['hi', f"{profiles[0].name}: turn 1"]
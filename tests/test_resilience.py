@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import asyncio
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import resilience
+from resilience import acall, call, get_limiter, CircuitOpenError, BREAKER_THRESHOLD
+
+class ServerError(Exception):
+    status = 500
+
+def open_breaker(provider: str, model: str):
+    """opens the breaker of a fresh limiter and waits out its reset"""
+    limiter = get_limiter(provider, model)
+    limiter.breaker.reset = 0.01
+    for _ in range(BREAKER_THRESHOLD):
+        limiter.breaker.fail()
+    time.sleep(0.02)
+    return limiter
+
+async def succeed():
+    return 'ok'
+
+def test_cancelled_trial_does_not_keep_the_breaker_open(monkeypatch):
+    monkeypatch.setattr(resilience, 'MAX_RETRIES', 0)
+    open_breaker('test', 'cancelled-trial')
+
+    async def main():
+        trial = asyncio.ensure_future(acall('test', 'cancelled-trial', asyncio.sleep, 10))
+        await asyncio.sleep(0.01)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        return await acall('test', 'cancelled-trial', succeed)
+
+    assert asyncio.run(main()) == 'ok'
+
+def test_only_one_trial_while_half_open():
+    open_breaker('test', 'single-trial')
+
+    async def main():
+        trial = asyncio.ensure_future(acall('test', 'single-trial', asyncio.sleep, 0.05, 'ok'))
+        await asyncio.sleep(0.01)
+        with pytest.raises(CircuitOpenError):
+            await acall('test', 'single-trial', succeed)
+        return await trial
+
+    assert asyncio.run(main()) == 'ok'
+
+def test_failed_trial_reopens_the_breaker(monkeypatch):
+    monkeypatch.setattr(resilience, 'MAX_RETRIES', 0)
+    limiter = open_breaker('test', 'failed-trial')
+    limiter.breaker.reset = 60
+
+    def fail():
+        raise ServerError()
+
+    limiter.breaker.opened -= 60
+    with pytest.raises(ServerError):
+        call('test', 'failed-trial', fail)
+    with pytest.raises(CircuitOpenError):
+        call('test', 'failed-trial', fail)
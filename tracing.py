@@ -0,0 +1,117 @@
+# Description: Span-based latency tracing and token/cost metering, written to a local JSONL trace file
+import os
+import json
+import time
+import uuid
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+#With TRACE_PATH set, e.g. to trace.jsonl, every finished span is appended to it as one json line.
+#Once the file would exceed TRACE_MAX_BYTES it is moved to TRACE_PATH.1, replacing the previous one,
+#so the trace takes at most twice that on disk.
+TRACE_PATH = os.environ.get('TRACE_PATH', '')
+TRACE_MAX_BYTES = int(os.environ.get('TRACE_MAX_BYTES', 64 * 1024 * 1024))
+#Durations of the last ROLLING_WINDOW spans per stage, for the p50/p95 panel
+ROLLING_WINDOW = 200
+
+#USD per 1K (prompt, completion) tokens
+PRICES = {
+    "gpt-4-0613": (0.03, 0.06),
+    "gpt-3.5-turbo-16k-0613": (0.003, 0.004),
+    "text-embedding-ada-002": (0.0001, 0),
+}
+
+_current = contextvars.ContextVar('span', default=None)
+_durations = {}
+_lock = Lock()
+#opened on the first span and kept open, so a span costs one buffered write
+_file = None
+
+class Span:
+    """a timed stage of a turn. Attributes set on it (tokens, bytes, cache hits...) are written with it"""
+    def __init__(self, name: str, parent=None, **attrs):
+        self.name = name
+        self.id = uuid.uuid4().hex[:16]
+        self.trace = parent.trace if parent is not None else self.id
+        self.parent = parent.id if parent is not None else None
+        self.attrs = attrs
+        self.start = time.time()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, key: str, value: float):
+        self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def meter(self, model: str, prompt_tokens: int, completion_tokens: int = 0, estimated: bool = False):
+        """records token usage and its cost"""
+        prompt_price, completion_price = PRICES.get(model, (0, 0))
+        self.set(
+            model=model,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cost_usd=round((prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000, 6)
+        )
+        if estimated:
+            self.set(tokens_estimated=True)
+
+@contextmanager
+def span(name: str, **attrs):
+    """times the enclosed block as a child of the current span. Works in threads and asyncio tasks,
+    since tasks and aio.submit inherit the current span from where they were created
+    """
+    current = Span(name, _current.get(), **attrs)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        _current.reset(token)
+        record(current, time.time() - current.start)
+
+def get_current_span() -> Span:
+    return _current.get()
+
+def record(finished: Span, duration: float):
+    entry = {
+        'trace': finished.trace,
+        'span': finished.id,
+        'parent': finished.parent,
+        'name': finished.name,
+        'start': round(finished.start, 6),
+        'duration_ms': round(duration * 1000, 3),
+        **finished.attrs
+    }
+    line = json.dumps(entry, default=str) + '\n'
+    global _file
+    with _lock:
+        _durations.setdefault(finished.name, deque(maxlen=ROLLING_WINDOW)).append(duration)
+        if TRACE_PATH:
+            if _file is None:
+                _file = open(TRACE_PATH, 'a', buffering=1)
+            if _file.tell() > 0 and _file.tell() + len(line) > TRACE_MAX_BYTES:
+                _file.close()
+                os.replace(TRACE_PATH, TRACE_PATH + '.1')
+                _file = open(TRACE_PATH, 'a', buffering=1)
+            _file.write(line)
+
+def get_stats() -> dict:
+    """returns count, p50 and p95 in milliseconds of the recent spans of each stage"""
+    with _lock:
+        durations = { name: sorted(values) for name, values in _durations.items() }
+    stats = {}
+    for name, values in sorted(durations.items()):
+        stats[name] = {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 0.5) * 1000, 1),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 1)
+        }
+    return stats
+
+def percentile(values: list, q: float) -> float:
+    """nearest-rank percentile of sorted values"""
+    return values[min(len(values) - 1, int(q * len(values)))]
@@ -1,6 +1,14 @@
 # Description: Utility functions for the app
+import os
 import openai
 import re
+import aio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache import CACHE_DIR, EmbeddingCache
+from tracing import span
+from resilience import call, acall
+from context import count_tokens
+from pool import Coalescer
 
 #Indicator ID for the end or beginning of a video chain
 #Required because of the way Pinecone stores data
@@ -9,9 +17,86 @@ NULL_ID = '\0'
 def is_null(datum) -> bool:
   return datum == NULL_ID
 
+#Embeddings are deterministic per (model, text), so they are cached in memory and on disk
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get('EMBEDDING_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+EMBEDDING_CACHE_MEMORY_BYTES = int(os.environ.get('EMBEDDING_CACHE_MEMORY_BYTES', 16 * 1024 * 1024))
+EMBEDDING_CACHE = EmbeddingCache(
+    os.path.join(CACHE_DIR, 'embeddings'),
+    max_bytes=EMBEDDING_CACHE_MAX_BYTES,
+    memory_bytes=EMBEDDING_CACHE_MEMORY_BYTES
+)
+#Concurrent requests for the same uncached embedding share one API call
+EMBEDDING_REQUESTS = Coalescer()
+
+#Bulk embedding packs up to EMBEDDING_BATCH_SIZE inputs and EMBEDDING_BATCH_TOKENS estimated tokens
+#into each request, and sends EMBEDDING_WORKERS requests at once
+EMBEDDING_BATCH_SIZE = 2048
+EMBEDDING_BATCH_TOKENS = int(os.environ.get('EMBEDDING_BATCH_TOKENS', 50000))
+EMBEDDING_WORKERS = int(os.environ.get('EMBEDDING_WORKERS', 4))
+
 def get_embedding(text, model="text-embedding-ada-002"):
    text = text.replace("\n", " ")
-   return openai.Embedding.create(input = [text], model=model)['data'][0]['embedding']
+   embedding = EMBEDDING_CACHE.get(model, text)
+   if embedding is None:
+      response = call('openai', model, openai.Embedding.create, input = [text], model=model, tokens=count_tokens(text))
+      embedding = response['data'][0]['embedding']
+      EMBEDDING_CACHE.put(model, text, embedding)
+   return embedding
+
+async def aget_embedding(text, model="text-embedding-ada-002"):
+   text = text.replace("\n", " ")
+   with span('embedding') as embedding_span:
+      embedding = EMBEDDING_CACHE.get(model, text)
+      embedding_span.set(cache_hit=embedding is not None, hit_rate=EMBEDDING_CACHE.get_stats()['hit_rate'])
+      if embedding is None:
+         aio.get_session()
+
+         async def embed():
+            response = await acall('openai', model, openai.Embedding.acreate, input = [text], model=model, tokens=count_tokens(text))
+            embedding_span.meter(model, response['usage']['prompt_tokens'])
+            EMBEDDING_CACHE.put(model, text, response['data'][0]['embedding'])
+            return response['data'][0]['embedding']
+
+         embedding = await EMBEDDING_REQUESTS.run((model, text), embed)
+   return embedding
+
+def get_embeddings(texts: list[str], model="text-embedding-ada-002", on_batch=None) -> list[list[float]]:
+    """returns the embedding of each of texts, in order, like get_embedding but in a few batched
+    requests. Cached and repeated texts are not sent.
+    on_batch is called with the number of texts embedded by each request as it completes.
+    """
+    texts = [ text.replace("\n", " ") for text in texts ]
+    embeddings = [ EMBEDDING_CACHE.get(model, text) for text in texts ]
+    missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+
+    batches = []
+    batch, batch_tokens = [], 0
+    for text in missing:
+        tokens = count_tokens(text)
+        if len(batch) > 0 and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_TOKENS):
+            batches.append((batch, batch_tokens))
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if len(batch) > 0:
+        batches.append((batch, batch_tokens))
+
+    def embed(batch: list[str], tokens: int) -> list[tuple]:
+        response = call('openai', model, openai.Embedding.create, input=batch, model=model, tokens=tokens)
+        #each result carries the position of its input
+        return [ (batch[item['index']], item['embedding']) for item in response['data'] ]
+
+    embedded = {}
+    with ThreadPoolExecutor(EMBEDDING_WORKERS) as executor:
+        futures = [ executor.submit(embed, batch, tokens) for batch, tokens in batches ]
+        for future in as_completed(futures):
+            results = future.result()
+            for text, embedding in results:
+                EMBEDDING_CACHE.put(model, text, embedding)
+                embedded[text] = embedding
+            if on_batch is not None:
+                on_batch(len(results))
+    return [ embedding if embedding is not None else embedded[text] for text, embedding in zip(texts, embeddings) ]
 
 def extract_video_link_and_start_time(url):
     result = url.split('&t=')
@@ -25,6 +110,23 @@ def extract_reference_numbers(text: str) -> list[int]:
     references = [int(ref) for match in matches for ref in match.split(',')]
     return references
 
+#end of a sentence: terminal punctuation, optional closing quotes/brackets, then whitespace
+SENTENCE_END = re.compile(r'(?<=[.!?])["\')\]]*\s+')
+
+def split_sentences(text: str, min_length: int = 0) -> tuple[list[str], str]:
+    """splits the complete sentences off the front of text.
+    Sentences shorter than min_length are merged with the next one.
+    returns the sentences and the unfinished remainder
+    """
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        sentence = text[start:match.end()].strip()
+        if len(sentence) >= min_length:
+            sentences.append(sentence)
+            start = match.end()
+    return sentences, text[start:]
+
 def strip_citations(text) -> str:
     pattern = r"\((\d+(?:,\d+)*)\)"
     stripped_text = re.sub(pattern, '', text)
@@ -0,0 +1,292 @@
+# Description: Vector index backends for the knowledge base
+import os
+import json
+import numpy as np
+from typing import Protocol
+
+class VectorIndex(Protocol):
+    """interface of the index behind PineconeKnowledgeBase.
+    pinecone.Index already satisfies it, so any backend only has to mimic its query and fetch responses.
+    """
+    def query(self, vector, top_k, include_metadata=True, filter=None) -> dict:
+        """returns {'matches': [{'id', 'score', 'metadata'}, ...]} ordered by descending score"""
+        ...
+
+    def fetch(self, ids) -> dict:
+        """returns {'vectors': {id: {'id', 'metadata'}, ...}}"""
+        ...
+
+class LocalIndex:
+    """exact cosine search over a memory-mapped float32 embedding matrix.
+    Rows are grouped by politician so each politician is a contiguous slice, and the
+    matrix file is mapped read-only so several worker processes share the same pages.
+    """
+    EMBEDDINGS_FILE = 'embeddings.npy'
+    METADATA_FILE = 'metadata.json'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.embeddings = np.load(os.path.join(path, self.EMBEDDINGS_FILE), mmap_mode='r')
+        with open(os.path.join(path, self.METADATA_FILE)) as f:
+            data = json.load(f)
+        self.ids = data['ids']
+        self.metadatas = data['metadatas']
+        #the size on disk, as a lower bound of what the loaded metadata takes in memory
+        self.metadata_bytes = os.path.getsize(os.path.join(path, self.METADATA_FILE))
+        self.slices = { politician: tuple(bounds) for politician, bounds in data['slices'].items() }
+        self.rows = { id: row for row, id in enumerate(self.ids) }
+
+    def get_metadata(self, row: int) -> dict:
+        if self.metadatas is None:
+            raise ValueError(f'{type(self).__name__} was loaded without metadata, query it with include_metadata=False')
+        return self.metadatas[row]
+
+    def get_slice(self, filter) -> tuple:
+        if filter is None:
+            return (0, len(self.ids))
+        if set(filter.keys()) != {'politician'}:
+            raise ValueError(f'LocalIndex only supports filtering by politician, got {filter}')
+        return self.slices.get(filter['politician'], (0, 0))
+
+    def query(self, vector, top_k, include_metadata=True, filter=None) -> dict:
+        start, end = self.get_slice(filter)
+        if end <= start:
+            return {'matches': []}
+
+        xq = np.asarray(vector, dtype=np.float32)
+        xq = xq / np.linalg.norm(xq)
+        scores = self.embeddings[start:end] @ xq
+
+        k = min(top_k, end - start)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        matches = []
+        for i in top:
+            row = start + int(i)
+            match = {'id': self.ids[row], 'score': float(scores[i])}
+            if include_metadata:
+                match['metadata'] = self.get_metadata(row)
+            matches.append(match)
+        return {'matches': matches}
+
+    def fetch(self, ids) -> dict:
+        vectors = {
+            id: {'id': id, 'metadata': self.get_metadata(self.rows[id])} for id in ids if id in self.rows
+        }
+        return {'vectors': vectors}
+
+    @classmethod
+    def build(cls, path: str, ids: list, embeddings: list, metadatas: list):
+        """writes a local index from parallel lists of chunk ids, embeddings and metadatas"""
+        os.makedirs(path, exist_ok=True)
+
+        #sort rows by politician so each politician gets a contiguous slice
+        order = sorted(range(len(ids)), key=lambda i: metadatas[i]['politician'])
+        ids = [ ids[i] for i in order ]
+        metadatas = [ metadatas[i] for i in order ]
+
+        matrix = np.asarray([ embeddings[i] for i in order ], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1, norms)
+
+        slices = {}
+        for row, md in enumerate(metadatas):
+            start, _ = slices.get(md['politician'], (row, row))
+            slices[md['politician']] = (start, row + 1)
+
+        np.save(os.path.join(path, cls.EMBEDDINGS_FILE), matrix)
+        with open(os.path.join(path, cls.METADATA_FILE), 'w') as f:
+            json.dump({'ids': ids, 'metadatas': metadatas, 'slices': slices}, f)
+
+def kmeans(data: np.ndarray, k: int, iterations: int = 20, seed: int = 0) -> np.ndarray:
+    """returns k centroids of data by Lloyd's algorithm, initialized from a random sample"""
+    rng = np.random.default_rng(seed)
+    k = min(k, len(data))
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign(data, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        #reseed empty clusters so every centroid stays useful
+        empty = np.flatnonzero(~filled)
+        centroids[empty] = data[rng.integers(len(data), size=len(empty))]
+    return centroids
+
+def assign(data: np.ndarray, centroids: np.ndarray, batch_size: int = 8192) -> np.ndarray:
+    """returns the index of the nearest centroid (squared L2) for each row of data"""
+    norms = (centroids ** 2).sum(axis=1)
+    assignments = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), batch_size):
+        batch = data[start:start+batch_size]
+        assignments[start:start+batch_size] = np.argmin(norms - 2 * batch @ centroids.T, axis=1)
+    return assignments
+
+class IVFPQIndex(LocalIndex):
+    """approximate cosine search over product-quantized embeddings, with an inverted file per politician.
+    Each politician's chunks are clustered into lists around coarse centroids; residuals to the centroid are
+    compressed to PQ_SUBSPACES one-byte codes. A query scans the IVF_NPROBE nearest lists by asymmetric
+    distance, then re-ranks the RERANK_FACTOR * top_k best candidates exactly against the memory-mapped
+    float32 embeddings, so only the shortlisted rows are ever paged in.
+    Trained from a LocalIndex directory by setup/train_ivfpq.py and stored next to it.
+    With metadata=False only the chunk ids are loaded, for use with a chunk store that serves the text:
+    every worker then holds the compressed index and ids, not the transcripts.
+    """
+    IVFPQ_FILE = 'ivfpq.npz'
+    #128 one-byte codes instead of 1536 float32s: 48x smaller
+    PQ_SUBSPACES = 128
+    PQ_CENTROIDS = 256
+    PQ_TRAINING_SAMPLE = 65536
+    IVF_NPROBE = int(os.environ.get('IVF_NPROBE', 8))
+    RERANK_FACTOR = 10
+
+    def __init__(self, path: str, metadata: bool = True):
+        if metadata:
+            super().__init__(path)
+        else:
+            self.path = path
+            self.embeddings = np.load(os.path.join(path, self.EMBEDDINGS_FILE), mmap_mode='r')
+            self.metadatas = None
+            self.slices = {}
+        with np.load(os.path.join(path, self.IVFPQ_FILE)) as data:
+            if not metadata:
+                ids = data['ids']
+                self.ids = ids.tolist()
+                self.metadata_bytes = ids.nbytes
+                self.rows = { id: row for row, id in enumerate(self.ids) }
+            self.codes = data['codes']
+            self.code_rows = data['rows']
+            self.centroids = data['centroids']
+            self.list_bounds = data['list_bounds']
+            #a fixed 1.5 MB whatever the corpus size, so kept in single precision for fast lookup tables
+            self.codebooks = data['codebooks'].astype(np.float32)
+            partition_lists = data['partition_lists']
+            politicians = data['politicians']
+        self.partition_lists = {
+            str(politician): (int(first), int(last)) for politician, (first, last) in zip(politicians, partition_lists)
+        }
+
+    def query(self, vector, top_k, include_metadata=True, filter=None) -> dict:
+        if filter is None:
+            #exact search over everything; the compressed index only serves per-politician queries
+            return super().query(vector, top_k, include_metadata, filter)
+        politician = self.get_politician(filter)
+        first, last = self.partition_lists.get(politician, (0, 0))
+        if last <= first:
+            return {'matches': []}
+
+        xq = np.asarray(vector, dtype=np.float32)
+        xq = xq / np.linalg.norm(xq)
+
+        #nearest lists by inner product with their centroids
+        list_scores = self.centroids[first:last].astype(np.float32) @ xq
+        nprobe = min(self.IVF_NPROBE, last - first)
+        probed = first + np.argpartition(-list_scores, nprobe - 1)[:nprobe]
+
+        #asymmetric distance: inner product of the query with each reconstructed residual, by table lookup
+        M, _, dsub = self.codebooks.shape
+        table = np.einsum('mkd,md->mk', self.codebooks, xq.reshape(M, dsub))
+        candidates, approx_scores = [], []
+        for list_id in probed:
+            start, end = self.list_bounds[list_id], self.list_bounds[list_id + 1]
+            if end <= start:
+                continue
+            codes = self.codes[start:end]
+            scores = list_scores[list_id - first] + table[np.arange(M), codes].sum(axis=1)
+            candidates.append(self.code_rows[start:end])
+            approx_scores.append(scores)
+        if len(candidates) == 0:
+            return {'matches': []}
+        candidates = np.concatenate(candidates)
+        approx_scores = np.concatenate(approx_scores)
+
+        #exact re-ranking of the shortlist, reading rows in file order
+        k = min(self.RERANK_FACTOR * top_k, len(candidates))
+        shortlist = np.sort(candidates[np.argpartition(-approx_scores, k - 1)[:k]])
+        scores = self.embeddings[shortlist] @ xq
+        top = np.argsort(-scores)[:top_k]
+
+        matches = []
+        for i in top:
+            row = int(shortlist[i])
+            match = {'id': self.ids[row], 'score': float(scores[i])}
+            if include_metadata:
+                match['metadata'] = self.get_metadata(row)
+            matches.append(match)
+        return {'matches': matches}
+
+    def get_politician(self, filter) -> str:
+        if set(filter.keys()) != {'politician'}:
+            raise ValueError(f'IVFPQIndex only supports filtering by politician, got {filter}')
+        return filter['politician']
+
+    @classmethod
+    def train(cls, path: str, subspaces: int = None, seed: int = 0):
+        """trains coarse centroids per politician and shared PQ codebooks over the embeddings of the
+        LocalIndex at path, and writes the compressed index next to them
+        """
+        subspaces = subspaces or cls.PQ_SUBSPACES
+        embeddings = np.load(os.path.join(path, cls.EMBEDDINGS_FILE), mmap_mode='r')
+        with open(os.path.join(path, cls.METADATA_FILE)) as f:
+            data = json.load(f)
+        ids, slices = data['ids'], data['slices']
+        del data
+        n, d = embeddings.shape
+        if d % subspaces != 0:
+            raise ValueError(f'{subspaces} subspaces do not divide {d} dimensions')
+        dsub = d // subspaces
+
+        #coarse quantizer: about sqrt(n) lists per politician
+        politicians = sorted(slices.keys())
+        centroids, assignments, partition_lists = [], np.empty(n, dtype=np.int64), []
+        for politician in politicians:
+            start, end = slices[politician]
+            data = np.asarray(embeddings[start:end], dtype=np.float32)
+            nlist = max(1, int(np.sqrt(end - start)))
+            partition_centroids = kmeans(data, nlist, seed=seed)
+            first = sum(len(c) for c in centroids)
+            assignments[start:end] = first + assign(data, partition_centroids)
+            centroids.append(partition_centroids)
+            partition_lists.append((first, first + len(partition_centroids)))
+        centroids = np.concatenate(centroids).astype(np.float32)
+
+        #product quantizer over residuals, shared by all politicians
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n, size=min(n, cls.PQ_TRAINING_SAMPLE), replace=False))
+        residuals = np.asarray(embeddings[sample], dtype=np.float32) - centroids[assignments[sample]]
+        ksub = min(cls.PQ_CENTROIDS, len(sample))
+        codebooks = np.stack([
+            kmeans(residuals[:, m*dsub:(m+1)*dsub], ksub, seed=seed) for m in range(subspaces)
+        ]).astype(np.float32)
+
+        #encode every row and group the codes by list
+        codes = np.empty((n, subspaces), dtype=np.uint8)
+        for start in range(0, n, 8192):
+            batch = np.asarray(embeddings[start:start+8192], dtype=np.float32) - centroids[assignments[start:start+8192]]
+            for m in range(subspaces):
+                codes[start:start+8192, m] = assign(batch[:, m*dsub:(m+1)*dsub], codebooks[m])
+        order = np.argsort(assignments, kind='stable')
+        list_bounds = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+
+        #centroids and codebooks only steer the approximate scores, so half precision is enough
+        np.savez(
+            os.path.join(path, cls.IVFPQ_FILE),
+            codes=codes[order],
+            rows=order.astype(np.int32),
+            centroids=centroids.astype(np.float16),
+            list_bounds=list_bounds,
+            codebooks=codebooks.astype(np.float16),
+            partition_lists=np.asarray(partition_lists, dtype=np.int64),
+            politicians=np.asarray(politicians),
+            ids=np.asarray(ids)
+        )
+
+    def get_resident_bytes(self) -> int:
+        """bytes held in memory by each worker: the compressed index and the ids or metadata,
+        excluding the memory-mapped embeddings
+        """
+        index_bytes = self.codes.nbytes + self.code_rows.nbytes + self.centroids.nbytes + self.codebooks.nbytes + self.list_bounds.nbytes
+        return index_bytes + self.metadata_bytes